@@ -1,10 +1,18 @@
 # fsl_sub plugin for:
 #  * Slurm
+import copy
 import datetime
 import logging
 import os
+import pickle
+import re
 import subprocess as sp
+import tempfile
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
 from ruamel.yaml.comments import CommentedMap
 from shutil import which, move
 
@@ -31,7 +39,6 @@ from fsl_sub.utils import (
     parse_array_specifier,
     bash_cmd,
     fix_permissions,
-    flatten_list,
     job_script,
     write_wrapper,
     update_envvar_list,
@@ -40,6 +47,56 @@ from .version import PLUGIN_VERSION
 
 
 METHOD_NAME = 'slurm'
+# Maximum number of concurrent sinfo queries when building queue definitions
+_QUERY_WORKERS = 4
+# Optional on-disk cache of partition information, enabled with FSLSUB_SLURM_CACHE=1
+_PARTITION_CACHE_FILE = os.path.join(
+    os.path.expanduser('~'), '.cache', 'fsl_sub', 'slurm_partitions.pkl')
+# Run time used for partitions with an infinite time limit, 365-23:59:59
+_INFINITE_MINUTES = 365 * 24 * 60 + 23 * 60 + 59
+# Seconds for which sacct results are reused by repeated status queries
+_SACCT_CACHE_TTL = 5
+# sacct results keyed on job list, values are (query time, parsed jobs)
+_sacct_cache = {}
+# Fields requested from sacct, in output column order
+_SACCT_FIELDS = (
+    'JobID',
+    'JobName',
+    'Submit',
+    'Start',
+    'End',
+    'State',
+    'ExitCode',
+)
+_SACCT_ARGS = (
+    '--parsable2',
+    '--noheader',
+    '--units=M',
+    '--duplicate',
+    '--format', ','.join(_SACCT_FIELDS),
+)
+# fsl_sub job/array variables and the Slurm variables that provide them
+_ARRAY_EXPORT_VARS = (
+    'FSLSUB_JOB_ID_VAR=SLURM_JOB_ID',
+    'FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID',
+    'FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN',
+    'FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX',
+    'FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP',
+    'FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT',
+    'FSLSUB_NSLOTS=SLURM_NPROCS',
+)
+# sacct durations, [DD-[HH:]]MM:SS[.sss] or a bare seconds value
+_SACCT_TIMESTAMP_RE = re.compile(
+    r'^(?:(\d+)-)?(?:(?:(\d+):)?(\d+):)?(\d+(?:\.\d*)?)$')
+# Map of Slurm job states to fsl_sub states - anything else is a failure
+_STATE_MAP = {
+    'REQUEUED': fsl_sub.consts.REQUEUED,
+    'SUSPENDED': fsl_sub.consts.SUSPENDED,
+    'RUNNING': fsl_sub.consts.RUNNING,
+    'RESIZING': fsl_sub.consts.RUNNING,
+    'PENDING': fsl_sub.consts.QUEUED,
+    'COMPLETED': fsl_sub.consts.FINISHED,
+}
 
 
 def plugin_version():
@@ -51,6 +108,7 @@ def qtest():
     return _sinfo_cmd()
 
 
+@lru_cache()
 def _sinfo_cmd():
     '''Command that queries queue configuration'''
     qconf = which('sinfo')
@@ -59,6 +117,7 @@ def _sinfo_cmd():
     return qconf
 
 
+@lru_cache()
 def _qsub_cmd():
     '''Command that submits a job'''
     qsub = which('sbatch')
@@ -67,6 +126,7 @@ def _qsub_cmd():
     return qsub
 
 
+@lru_cache()
 def _sacctmgr_cmd():
     '''Command that manages accounts'''
     sacctmgr = which('sacctmgr')
@@ -75,6 +135,7 @@ def _sacctmgr_cmd():
     return sacctmgr
 
 
+@lru_cache()
 def _sacct_cmd():
     '''Command that queries job stats'''
     sacct = which('sacct')
@@ -83,6 +144,7 @@ def _sacct_cmd():
     return sacct
 
 
+@lru_cache()
 def _squeue_cmd():
     '''Command that queries running job stats'''
     squeue = which('squeue')
@@ -91,28 +153,31 @@ def _squeue_cmd():
     return squeue
 
 
+@lru_cache()
+def _scancel_cmd():
+    '''Command that deletes jobs'''
+    scancel = which('scancel')
+    if scancel is None:
+        raise BadSubmission("Cannot find Slurm software")
+    return scancel
+
+
 def queue_exists(qname, qtest=None):
-    '''Does qname exist'''
+    '''Does qname exist - all of the partitions in a comma separated list
+    must exist'''
     if qtest is None:
-        qtest = which('sinfo')
-        if qtest is None:
-            raise BadSubmission("Cannot find Slurm software")
-    if '@' in qname:
-        qlist = []
-        for q in qname.split(','):
-            qlist.append(q.split('@')[0])
-        qname = ','.join(qlist)
+        qtest = _sinfo_cmd()
+    qlist = [q.partition('@')[0] for q in qname.split(',')]
     try:
         output = sp.run(
-            [qtest, '--noheader', '-p', qname],
+            [qtest, '--noheader', '-p', ','.join(qlist), '-o', '%P'],
             stdout=sp.PIPE,
             check=True, universal_newlines=True)
     except sp.CalledProcessError:
         raise BadSubmission("Cannot run Slurm software")
-    if output.stdout:
-        return True
-    else:
-        return False
+    # The default partition is marked with a '*'
+    partitions = set(p.rstrip('*') for p in output.stdout.split())
+    return all(q in partitions for q in qlist)
 
 
 def already_queued():
@@ -122,11 +187,15 @@ def already_queued():
 
 def qdel(job_id):
     '''Deletes a job - returns a tuple, output, return code'''
-    scancel = which('scancel')
-    if scancel is None:
-        raise BadSubmission("Cannot find Slurm software")
+    return qdel_many([job_id, ])
+
+
+def qdel_many(job_ids):
+    '''Deletes the list of jobs with a single scancel call - returns a tuple,
+    output, return code'''
+    scancel = _scancel_cmd()
     result = sp.run(
-        [scancel, str(job_id), ],
+        [scancel, ] + [str(j) for j in job_ids],
         universal_newlines=True,
         stdout=sp.PIPE, stderr=sp.STDOUT
     )
@@ -141,6 +210,38 @@ def _get_logger():
     return logging.getLogger('fsl_sub.' + __name__)
 
 
+def _count_lines(filename):
+    '''Count the lines in a file without reading it all into memory'''
+    lines = 0
+    last = b'\n'
+    with open(filename, 'rb') as f:
+        for buf in iter(lambda: f.read(1 << 16), b''):
+            lines += buf.count(b'\n')
+            last = buf[-1:]
+    if last != b'\n':
+        # Last line isn't newline terminated
+        lines += 1
+    return lines
+
+
+def _invoke_sbatch(argv, script=None):
+    '''Run the sbatch command line argv, passing script (if provided) on stdin,
+    returning the new job ID'''
+    run_args = {}
+    if script is not None:
+        run_args['input'] = script
+    result = sp.run(
+        argv, universal_newlines=True,
+        stdout=sp.PIPE, stderr=sp.PIPE, **run_args)
+    if result.returncode != 0:
+        raise BadSubmission(result.stderr)
+    job_words = result.stdout.split(';')
+    try:
+        return int(job_words[0].split('.')[0])
+    except ValueError:
+        raise GridOutputError("Grid output was " + result.stdout)
+
+
 def submit(
         command,
         job_name,
@@ -216,8 +317,10 @@ def submit(
     '''
 
     logger = _get_logger()
-    # We may need additional SLURM-specific queue configuration options
-    queue_config = read_config()["queues"].get(queue, None)
+    # We may need additional SLURM-specific queue configuration options.
+    # read_config() is memoised by fsl_sub so this doesn't re-read the YAML.
+    # Queues that aren't configured (e.g. multiple queues) have no options.
+    queue_config = read_config()["queues"].get(queue, None) or {}
 
     if command is None:
         raise BadSubmission(
@@ -233,27 +336,18 @@ def submit(
         export_vars = []
     my_export_vars = list(export_vars)
 
-    mconf = defaultdict(lambda: False, method_config(METHOD_NAME))
+    mconf = method_config(METHOD_NAME)
     qsub = _qsub_cmd()
     command_args = []
     extra_lines = []
 
     modules = []
+    cwd = os.getcwd()
     if logdir is None:
-        logdir = os.getcwd()
+        logdir = cwd
     if isinstance(resources, str):
         resources = [resources, ]
 
-    array_map = {
-        'FSLSUB_JOB_ID_VAR': 'SLURM_JOB_ID',
-        'FSLSUB_ARRAYTASKID_VAR': 'SLURM_ARRAY_TASK_ID',
-        'FSLSUB_ARRAYSTARTID_VAR': 'SLURM_ARRAY_TASK_MIN',
-        'FSLSUB_ARRAYENDID_VAR': 'SLURM_ARRAY_TASK_MAX',
-        'FSLSUB_ARRAYSTEPSIZE_VAR': 'SLURM_ARRAY_TASK_STEP',
-        'FSLSUB_ARRAYCOUNT_VAR': 'SLURM_ARRAY_TASK_COUNT',
-        'FSLSUB_NSLOTS': 'SLURM_NPROCS'
-    }
-
     if queue is None:
         raise BadSubmission("Queue not specified")
     if type(queue) == str:
@@ -263,7 +357,14 @@ def submit(
             queues = [queue, ]
     elif type(queue) == list:
         queues = queue
-    pure_queues = [q.split('@')[0] for q in queues]
+    # Split queue@host specifiers once into partitions and hosts
+    pure_queues = []
+    hlist = []
+    for q in queues:
+        qname, _, qhost = q.partition('@')
+        pure_queues.append(qname)
+        if qhost:
+            hlist.append(qhost)
 
     gres = []
     if usescript:
@@ -280,13 +381,10 @@ def submit(
             use_jobscript = True
         # Check Parallel Environment is available
         if parallel_env:
-            command_args.extend(
-                ['--ntasks-per-node', str(threads), ])
+            command_args.append('--ntasks-per-node={0}'.format(threads))
 
-        for var, value in array_map.items():
-            if not value:
-                value = '""'
-            update_envvar_list(my_export_vars, '='.join((var, value)))
+        for var in _ARRAY_EXPORT_VARS:
+            update_envvar_list(my_export_vars, var)
         if mconf.get('copy_environment', False):
             my_export_vars.insert(0, 'ALL')
 
@@ -309,9 +407,7 @@ def submit(
                 else:
                     my_evars.append(var)
 
-            command_args.append(
-                '='.join(('--export', ','.join(my_evars)))
-            )
+            command_args.append('--export=' + ','.join(my_evars))
 
         def cp_class_item(cp, cpclass, item):
             return cp['class_types'][cpclass][item]
@@ -334,24 +430,19 @@ def submit(
 
                 if class_constraint:
                     if cpconf.get('include_more_capable', True) and not coprocessor_class_strict:
-                        cp_capability = cp_class_item(cpconf, coprocessor_class, 'capability')
-                        base_list = [
-                            a for a in cpconf['class_types'].keys()
-                            if cpconf['class_types'][a]['capability'] > cp_capability]
-                        [cpclasses.append(
-                            cpconf['class_types'][a]['resource']) for a in
-                            sorted(
-                                base_list,
-                                key=lambda x:
-                                cpconf['class_types'][x]['capability'])
-                            if a not in cpclasses]
+                        class_types = cpconf['class_types']
+                        cp_capability = class_types[coprocessor_class]['capability']
+                        # This class and all more capable classes, least capable first
+                        capable = sorted(
+                            (ct['capability'], ct['resource']) for ct in class_types.values()
+                            if ct['capability'] >= cp_capability)
+                        cpclasses.extend(
+                            [resource for _, resource in capable if resource not in cpclasses])
                     else:
                         cpclasses.append(cp_class_item(cpconf, coprocessor_class, 'resource'))
 
                     constraints = [":".join((class_constraint, cpc)) for cpc in cpclasses]
-                    command_args.append('='.join(
-                        ('--constraint', '"{0}"'.format('|'.join(constraints)))
-                    ))
+                    command_args.append('--constraint="{0}"'.format('|'.join(constraints)))
                 else:
                     if len(cpclasses) == 1:
                         gres_items.insert(1, cpclasses[0])
@@ -365,32 +456,23 @@ def submit(
             gres.append(','.join(resources))
 
         if gres:
-            command_args.append('='.join(
-                ('--gres', ",".join(gres))
-            ))
+            command_args.append('--gres=' + ','.join(gres))
 
         if logdir == '/dev/null':
-            command_args.append(['-o', logdir, ])
-            command_args.append(['-e', logdir, ])
+            command_args.append('-o ' + logdir)
+            command_args.append('-e ' + logdir)
         else:
-            logs = {}
-            for lf in ['o', 'e', ]:
-                if array_task:
-                    logtemplate = '{0}.{1}%A.%a'
-                else:
-                    logtemplate = '{0}.{1}%j'
-                logs[lf] = os.path.join(
-                    logdir,
-                    logtemplate.format(
-                        job_name.replace(' ', '_'),
-                        lf)
-                )
-            command_args.append(['-o', logs['o'], ])
-            command_args.append(['-e', logs['e'], ])
+            if array_task:
+                log_suffix = '%A.%a'
+            else:
+                log_suffix = '%j'
+            logbase = os.path.join(logdir, job_name.replace(' ', '_'))
+            command_args.append('-o {0}.o{1}'.format(logbase, log_suffix))
+            command_args.append('-e {0}.e{1}'.format(logbase, log_suffix))
 
         hold_state = 'afterok'
         if array_task and array_hold is not None:
-            if mconf['array_holds']:
+            if mconf.get('array_holds', False):
                 # Requires Slurm 16.05
                 jobhold = array_hold
                 hold_state = 'aftercorr'
@@ -407,17 +489,11 @@ def submit(
             else:
                 raise BadSubmission(
                     "jobhold is of unsupported type " + type(jobhold))
-            command_args.append(
-                "=".join(
-                    (
-                        '--dependency',
-                        hold_state + ':' + parents)
-                )
-            )
+            command_args.append('--dependency={0}:{1}'.format(hold_state, parents))
 
         if array_task is not None:
             # ntasks%array_limit
-            if mconf['array_limits'] and array_limit:
+            if mconf.get('array_limit', False) and array_limit:
                 array_limit_modifier = "%{}".format(array_limit)
             else:
                 array_limit_modifier = ""
@@ -435,52 +511,29 @@ def submit(
             if ramsplit:
                 jobram = split_ram_by_slots(jobram, threads)
                 # mem-per-cpu if dividing RAM up, otherwise mem
-            if mconf['notify_ram_usage']:
-                command_args.append(
-                    '='.join((
-                        '--mem-per-cpu',
-                        str(jobram) + fsl_sub.consts.RAMUNITS
-                    ))
-                )
+            if mconf.get('notify_ram_usage', False):
+                command_args.append('--mem-per-cpu={0}{1}'.format(jobram, fsl_sub.consts.RAMUNITS))
         try:
             no_set_tlimit = (os.environ['FSLSUB_NOTIMELIMIT'] == '1' or affirmative(os.environ['FSLSUB_NOTIMELIMIT']))
         except Exception:
             no_set_tlimit = False
         if jobtime:
-            if mconf['set_time_limit'] and not no_set_tlimit:
-                command_args.append(['-t', jobtime])
-        if mconf['mail_support']:
+            if mconf.get('set_time_limit', False) and not no_set_tlimit:
+                command_args.append('-t ' + str(jobtime))
+        if mconf.get('mail_support', False):
             if mailto:
-                command_args.extend(['-M', mailto, ])
+                command_args.append('--mail-user=' + mailto)
                 if not mail_on:
-                    mail_on = mconf['mail_mode']
-                if mail_on not in mconf['mail_modes']:
+                    mail_on = mconf.get('mail_mode', 'n')
+                if mail_on not in mconf.get('mail_modes', {}):
                     raise BadSubmission("Unrecognised mail mode")
-                command_args.append(
-                    '='.join((
-                        '--mail-type',
-                        ','.join(mconf['mail_mode'][mail_on]),
-                    ))
-                )
-        command_args.append(
-            '='.join((
-                '--job-name', job_name, ))
-        )
+                command_args.append('--mail-type=' + ','.join(mconf['mail_modes'][mail_on]))
+        command_args.append('--job-name=' + job_name)
         # Set current working directory
-        command_args.append(
-            '='.join((
-                '--chdir', os.getcwd()
-            ))
-        )
-        hlist = []
-        for q in queues:
-            if '@' in q:
-                qname, qhost = q.split('@')
-                hlist.append(qhost)
-
-        command_args.append(['-p', ','.join(pure_queues)])
+        command_args.append('--chdir=' + cwd)
+        command_args.append('-p ' + ','.join(pure_queues))
         if hlist:
-            command_args.append(['-w', ','.join(hlist), ])
+            command_args.append('-w ' + ','.join(hlist))
         command_args.append('--parsable')
 
         if requeueable:
@@ -489,12 +542,8 @@ def submit(
         if project is not None:
             command_args.append('--account ' + project)
 
-        if queue_config is not None and queue_config.get("qos", None):
-            command_args.append(
-                '='.join((
-                    '--qos', queue_config["qos"]
-                ))
-            )
+        if queue_config.get("qos", None):
+            command_args.append('--qos=' + queue_config["qos"])
 
         if array_task:
             # Submit array task file
@@ -511,21 +560,13 @@ def submit(
                     array_spec += "-{0}".format(array_end)
                 if array_stride:
                     array_spec += ":{0}".format(array_stride)
-                command_args.append(
-                    "=".join('--array', "{0}{1}".format(
-                        array_spec,
-                        array_limit_modifier)))
+                command_args.append('--array={0}{1}'.format(array_spec, array_limit_modifier))
             else:
-                with open(command[0], 'r') as cmd_f:
-                    array_slots = len(cmd_f.readlines())
-                command_args.append(
-                    "=".join((
-                        '--array', "1-{0}{1}".format(
-                            array_slots,
-                            array_limit_modifier))))
+                array_slots = _count_lines(command[0])
+                command_args.append('--array=1-{0}{1}'.format(array_slots, array_limit_modifier))
 
-    logger.info("slurm_args: " + " ".join(
-        [str(a) for a in command_args if a != qsub]))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("slurm_args: " + " ".join(command_args))
 
     bash = bash_cmd()
 
@@ -544,8 +585,6 @@ def submit(
             else:
                 logger.info("executing single task")
 
-    logger.info(" ".join([str(a) for a in command_args]))
-    logger.debug(type(command_args))
     logger.debug(command_args)
 
     if array_task and not array_specifier:
@@ -570,7 +609,8 @@ def submit(
         command, command_args,
         '#SBATCH', (METHOD_NAME, plugin_version()),
         modules=modules, extra_lines=extra_lines, modules_paths=modules_paths)
-    logger.debug('\n'.join(js_lines))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('\n'.join(js_lines))
     if keep_jobscript:
         wrapper_name = write_wrapper(js_lines)
         logger.debug(wrapper_name)
@@ -581,33 +621,18 @@ def submit(
         if not usescript:
             command_args = []
         else:
-            command_args = flatten_list(command_args)
-            command_args.extend(command)
+            command_args = list(command)
 
     command_args.insert(0, qsub)
 
     if keep_jobscript:
-        result = sp.run(
-            command_args, universal_newlines=True,
-            stdout=sp.PIPE, stderr=sp.PIPE)
+        job_id = _invoke_sbatch(command_args)
     else:
-        result = sp.run(
-            command_args,
-            input='\n'.join(js_lines),
-            universal_newlines=True,
-            stdout=sp.PIPE, stderr=sp.PIPE
-        )
-    if result.returncode != 0:
-        raise BadSubmission(result.stderr)
-    job_words = result.stdout.split(';')
-    try:
-        job_id = int(job_words[0].split('.')[0])
-    except ValueError:
-        raise GridOutputError("Grid output was " + result.stdout)
+        job_id = _invoke_sbatch(command_args, '\n'.join(js_lines))
 
     if keep_jobscript:
         new_name = os.path.join(
-            os.getcwd(),
+            cwd,
             '_'.join(('wrapper', str(job_id))) + '.sh'
         )
         try:
@@ -621,6 +646,68 @@ def submit(
     return job_id
 
 
+def submit_many(commands, job_name, queue, logdir=None, **kwargs):
+    '''Submits a list of commands as a single Slurm array job, replacing
+    one sbatch call per command with one call in total.
+    Requires:
+
+    commands - list of commands, each a list or a command line string
+    job_name - Symbolic name for task
+    queue - Queue to submit to
+
+    Optional:
+    logdir - directory to put log files and the array task file in. If this
+        is /dev/null the task file is written to the current directory
+    Any other submit() keyword argument (except array_task and
+    array_specifier) is passed through. Commands must not contain newlines
+    as each occupies one line of the task file.
+
+    The array task file, <job_name>.<random>.tasks, must be on a file
+    system the compute nodes share as each task reads it at run time. It is
+    not removed - delete it once all of the array's tasks have finished.
+    Returns a list of the Slurm IDs (<job id>_<task id>) of the tasks, in
+    the same order as commands.
+    '''
+    if not commands:
+        raise BadSubmission("No commands to submit")
+    for option in ('array_task', 'array_specifier', ):
+        if option in kwargs:
+            raise BadSubmission(
+                "submit_many builds its own array job, {0} is not allowed".format(option))
+    task_lines = []
+    for cmd in commands:
+        if isinstance(cmd, (list, tuple, )):
+            cmd = ' '.join(cmd)
+        if '\n' in cmd or '\r' in cmd:
+            raise BadSubmission(
+                "Commands submitted together must not contain newlines")
+        task_lines.append(cmd + '\n')
+    if logdir is None:
+        logdir = os.getcwd()
+    if logdir == '/dev/null':
+        # Jobs run in the submission directory (--chdir) so the nodes can see it
+        task_dir = os.getcwd()
+    else:
+        task_dir = logdir
+    with tempfile.NamedTemporaryFile(
+            mode='w',
+            dir=task_dir,
+            prefix=job_name.replace(' ', '_') + '.',
+            suffix='.tasks',
+            delete=False) as task_f:
+        task_f.writelines(task_lines)
+    job_id = submit(
+        [task_f.name, ],
+        job_name,
+        queue,
+        array_task=True,
+        logdir=logdir,
+        **kwargs)
+    return [
+        '_'.join((str(job_id), str(task_id)))
+        for task_id in range(1, len(commands) + 1)]
+
+
 def _default_config_file():
     return os.path.join(
         os.path.realpath(os.path.dirname(__file__)),
@@ -680,116 +767,135 @@ def job_status(job_id, sub_job_id=None):
     return job_details
 
 
-def _get_sacct(job_id, sub_job_id=None):
-    sacct_args = [
-        '--parsable2',
-        '--noheader',
-        '--units=M',
-        '--duplicate',
-        '--format', ','.join((
-            'JobID',
-            'JobName',
-            'Submit',
-            'Start',
-            'End',
-            'State',
-            'ExitCode',
-        )
-        )
-    ]
-    if sub_job_id is not None:
-        job = ".".join(str(job_id), str(sub_job_id))
-    else:
-        job = str(job_id)
+def job_status_many(job_ids):
+    '''Return details for each of the jobs with the given IDs, querying Slurm
+    once for all of them.
+
+    Returns a dict keyed on job ID, each value as returned by job_status.
+    Jobs unknown to Slurm are omitted.'''
+    job_ids = [int(j) for j in job_ids]
+    if not job_ids:
+        return {}
+    try:
+        jobs = _run_sacct(','.join(str(j) for j in job_ids))
+    except Exception as e:
+        raise GridOutputError from e
+
+    return {j: jobs[j] for j in job_ids if j in jobs}
+
+
+def _parse_sacct(lines):
+    '''Build the job details from an iterable of sacct output lines,
+    returning a dict keyed on job ID'''
+    jobs = {}
+
+    failed = fsl_sub.consts.FAILED
+    n_fields = len(_SACCT_FIELDS)
+    rows = (line.rstrip('\n').split('|')[:n_fields] for line in lines if line.strip())
+    for (row_id, name, submitted, started, ended, status, exit_code) in rows:
+        if '.' in row_id:
+            continue
+        if '_' in row_id:
+            # An array task
+            jid, sjid = row_id.split('_')
+            jid, sjid = (int(jid), int(sjid))
+        else:
+            jid, sjid = (int(row_id), 1)
+
+        job = jobs.get(jid)
+        if job is None:
+            job = jobs[jid] = {'id': jid, 'tasks': {}, }
+
+        if int(exit_code.split(':')[0]) != 0:
+            status = failed
+        else:
+            status = _STATE_MAP.get(status, failed)
+        job['tasks'][sjid] = {
+            'status': status,
+            'start_time': _sacct_datetimestamp(started),
+            'end_time': _sacct_datetimestamp(ended),
+        }
+
+        job['sub_time'] = _sacct_datetimestamp(submitted)
+        job['name'] = name
+
+    return jobs
+
+
+def _clear_sacct_cache():
+    '''Forget all previously queried sacct results'''
+    _sacct_cache.clear()
+
+
+def _run_sacct(job_list):
+    '''Query sacct for the comma separated list of jobs, returning the
+    parsed job details keyed on job ID. Results are reused for
+    _SACCT_CACHE_TTL seconds'''
+    now = time.monotonic()
+    cached = _sacct_cache.get(job_list)
+    if cached is not None and now - cached[0] < _SACCT_CACHE_TTL:
+        return copy.deepcopy(cached[1])
     sacct = [_sacct_cmd()]
-    sacct.extend(['-j', job])
-    sacct.extend(sacct_args)
-    output = None
+    sacct.extend(['-j', job_list])
+    sacct.extend(_SACCT_ARGS)
     try:
+        # Collect both pipes together - reading one to EOF first could
+        # deadlock if sacct fills the other
         sacct_barsv = sp.run(
             sacct,
             stdout=sp.PIPE,
             stderr=sp.PIPE,
-            check=True, universal_newlines=True)
-        output = sacct_barsv.stdout
+            universal_newlines=True)
     except FileNotFoundError:
         raise BadSubmission(
             "Slurm software may not be correctly installed")
-    except sp.CalledProcessError as e:
-        raise GridOutputError(e.stderr)
-    if not output:
-        raise UnknownJobId
-
-    job = {}
-    job['tasks'] = {}
-
-    for line in output.splitlines():
-        fields = line.split('|')
-        if '.' in fields[0]:
-            continue
-        if '_' in fields[0]:
-            # An array task
-            jid, sjid = fields[0].split('_')
-            jid, sjid = (int(jid), int(sjid))
-        else:
-            jid, sjid = fields[0], 1
-            jid, sjid = (int(jid), int(sjid))
+    if sacct_barsv.returncode != 0:
+        raise GridOutputError(sacct_barsv.stderr)
+    jobs = _parse_sacct(sacct_barsv.stdout.splitlines())
 
-        job['id'] = jid
+    for expired in [k for k, (t, _) in _sacct_cache.items() if now - t >= _SACCT_CACHE_TTL]:
+        del _sacct_cache[expired]
+    if jobs:
+        # Don't remember jobs that sacct doesn't know about yet
+        _sacct_cache[job_list] = (now, copy.deepcopy(jobs))
+    return jobs
 
-        if sjid not in job['tasks']:
-            job['tasks'][sjid] = {}
 
-        task = job['tasks'][sjid]
-        exit_status = int(fields[6].split(':')[0])
-        if exit_status != 0:
-            task['status'] = fsl_sub.consts.FAILED
-        else:
-            status = fields[5]
-            if status == 'REQUEUED':
-                task['status'] = fsl_sub.consts.REQUEUED
-            elif status == 'SUSPENDED':
-                task['status'] = fsl_sub.consts.SUSPENDED
-            elif status in ['RUNNING', 'RESIZING']:
-                task['status'] = fsl_sub.consts.RUNNING
-            elif status == 'PENDING':
-                task['status'] = fsl_sub.consts.QUEUED
-            elif status == 'COMPLETED':
-                task['status'] = fsl_sub.consts.FINISHED
-            else:
-                task['status'] = fsl_sub.consts.FAILED
-        task['start_time'] = _sacct_datetimestamp(fields[3])
-        task['end_time'] = _sacct_datetimestamp(fields[4])
+def _get_sacct(job_id, sub_job_id=None):
+    # Query the whole job - 'job.N' would select a job step, not an array
+    # task - _get_data picks out the requested task
+    jobs = _run_sacct(str(job_id))
+    try:
+        return jobs[int(job_id)]
+    except KeyError:
+        raise UnknownJobId
 
-        job['sub_time'] = _sacct_datetimestamp(fields[2])
-        job['name'] = fields[1]
 
-    return job
+if hasattr(datetime.datetime, 'fromisoformat'):
+    _parse_timestamp = datetime.datetime.fromisoformat
+else:
+    # Python 3.6
+    def _parse_timestamp(output):
+        return datetime.datetime.strptime(output, '%Y-%m-%dT%H:%M:%S')
 
 
 def _sacct_datetimestamp(output):
     if output == 'Unknown':
         return None
-    return datetime.datetime.strptime(output, '%Y-%m-%dT%H:%M:%S')
+    return _parse_timestamp(output)
 
 
 def _sacct_timestamp_seconds(output):
     if output == 'Unknown':
         return None
 
-    duration = 0
-    if '-' in output:
-        duration += int(output.split('-')[0]) * 86400
-        output = output.split('-')[1]
-    index = output.count(':')
-    for sub_time in output.split(':'):
-        if '.' in sub_time:
-            stime = float(sub_time)
-        else:
-            stime = int(sub_time)
-        duration += stime * 60**index
-        index -= 1
-    return float(duration)
+    match = _SACCT_TIMESTAMP_RE.match(output)
+    if match is None:
+        raise ValueError("Unrecognised sacct duration " + output)
+    days, hours, minutes, seconds = match.groups()
+    return float(
+        int(days or 0) * 86400 + int(hours or 0) * 3600
+        + int(minutes or 0) * 60 + float(seconds))
 
 
 def _get_data(getter, job_id, sub_job_id=None):
@@ -799,9 +905,9 @@ def _get_data(getter, job_id, sub_job_id=None):
         return None
 
     if sub_job_id is not None:
-        for s_task in job_info[job_id]['tasks'].keys():
-            if s_task != sub_job_id:
-                del job_info[job_id]['tasks'][s_task]
+        job_info['tasks'] = {
+            s_task: task for s_task, task in job_info['tasks'].items()
+            if s_task == sub_job_id}
 
     return job_info
 
@@ -827,7 +933,8 @@ def project_list():
             "SLURM software may not be correctly installed")
     except sp.CalledProcessError as e:
         raise GridOutputError(e.stderr)
-    return [a[0] for a in accounts_out.stdout.split('|')]
+    # One 'account|description|organisation' record per line
+    return [a.split('|', 1)[0] for a in accounts_out.stdout.splitlines()]
 
 
 def _get_queues(sinfo=None):
@@ -947,7 +1054,7 @@ def _get_queue_info(queue, sinfo=None):
             sinfo_cmd,
             stdout=sp.PIPE,
             stderr=sp.DEVNULL,
-            check=True, universal_newlines=True)
+            check=True)
     except FileNotFoundError:
         raise BadSubmission(
             "SLURM software may not be correctly installed")
@@ -955,11 +1062,13 @@ def _get_queue_info(queue, sinfo=None):
         raise BadSubmission(
             "Queue {0} not found!".format(queue))
 
+    # Output is pure ASCII so parse the bytes directly, int() accepts bytes
     qvariants = []
     output = result.stdout
     conf_lines = output.splitlines()
     for cl in conf_lines:
-        (cpus, maxcpus, memory, qtime, _) = cl.split()
+        # Don't bother splitting the (unused) NodeHost column
+        (cpus, maxcpus, memory, qtime) = cl.split(None, 4)[:4]
         cpus = int(cpus)
         try:
             maxcpus = int(maxcpus)
@@ -969,9 +1078,7 @@ def _get_queue_info(queue, sinfo=None):
         memory = int(memory)
         if not mconfig['memory_in_gb']:
             memory = memory // 1000  # Memory reported in MB
-        if qtime == "infinite":
-            qtime = "365-23:59:59"
-        qtime = _day_time_minutes(qtime)
+        qtime = _INFINITE_MINUTES if qtime == b"infinite" else _day_time_minutes(qtime.decode('ascii'))
         qvariants.append((cpus, memory, qtime, ))
 
     qdef = {'qname': queue, 'cpus': None, 'memory': None, 'qtime': None, }
@@ -1013,29 +1120,15 @@ def _get_queue_info(queue, sinfo=None):
 
 def _day_time_minutes(dayt):
     '''Convert D-HH:MM:SS to minutes'''
-    if '-' in dayt:
-        (days, sub_day) = dayt.split('-')
-        days = int(days)
-    else:
-        sub_day = dayt
-        days = 0
-
-    if ':' not in sub_day:
-        minutes = 0
-        hours = 0
-        seconds = sub_day
-    elif sub_day.count(':') == 1:
-        (minutes, seconds) = sub_day.split(':')
-        hours = 0
-    else:
-        (hours, minutes, seconds) = sub_day.split(':')
-    hours = int(hours)
-    minutes = int(minutes)
-    seconds = int(seconds)
+    (days, _, sub_day) = dayt.rpartition('-')
+    # Left pad [[HH:]MM:]SS to a full (days, hours, minutes, seconds) tuple
+    (days, hours, minutes, seconds) = [int(days or 0)] + (
+        [0, 0] + [int(f) for f in sub_day.split(':')])[-3:]
 
-    if days == 0 and hours == 0 and minutes == 0 and seconds != 0:
-        minutes += 1
-    return days * (24 * 60) + hours * 60 + minutes
+    # Round sub-minute times up to one minute
+    return (
+        days * (24 * 60) + hours * 60 + minutes
+        + (1 if seconds and not (days or hours or minutes) else 0))
 
 
 def _add_comment(comments, comment):
@@ -1043,26 +1136,115 @@ def _add_comment(comments, comment):
         comments.append(comment)
 
 
+def _gather_queue(queue):
+    '''Return (queue info, comments, GRES, features) for a partition'''
+    qinfo, comments = _get_queue_info(queue)
+    gres = _get_queue_gres(queue)
+    features = _get_queue_features(queue)
+    return (qinfo, comments, gres, features)
+
+
+def _use_partition_cache():
+    '''Has the user asked for partition information to be cached on disk?'''
+    setting = os.environ.get('FSLSUB_SLURM_CACHE', '0')
+    return setting == '1' or affirmative(setting)
+
+
+def _slurm_conf_mtime():
+    '''Return modification time of the Slurm configuration file (or None)'''
+    slurm_conf = os.environ.get('SLURM_CONF', '/etc/slurm/slurm.conf')
+    try:
+        return os.stat(slurm_conf).st_mtime
+    except OSError:
+        return None
+
+
+def _partition_cache_key():
+    '''Return the values the partition cache must have been written with
+    to be reused, or None if there is no Slurm configuration file to check
+    against (e.g. configless Slurm)'''
+    mtime = _slurm_conf_mtime()
+    if mtime is None:
+        return None
+    return (mtime, method_config(METHOD_NAME)['memory_in_gb'], PLUGIN_VERSION, )
+
+
+def _load_partition_cache(key):
+    '''Return cached (partition list, partition data) if the cache was
+    written with the given cache key'''
+    try:
+        with open(_PARTITION_CACHE_FILE, 'rb') as cache_f:
+            cache = pickle.load(cache_f)
+    except Exception:
+        # Missing, corrupt or foreign cache files are just a cache miss
+        return None
+    if not isinstance(cache, dict) or cache.get('key') != key:
+        return None
+    return cache['partitions']
+
+
+def _save_partition_cache(key, partitions):
+    '''Atomically write partitions to the cache file'''
+    logger = _get_logger()
+    cache_dir = os.path.dirname(_PARTITION_CACHE_FILE)
+    temp_name = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode='wb', dir=cache_dir, delete=False) as cache_f:
+            temp_name = cache_f.name
+            pickle.dump({'key': key, 'partitions': partitions, }, cache_f)
+        os.replace(temp_name, _PARTITION_CACHE_FILE)
+    except (OSError, pickle.PicklingError, ) as e:
+        logger.warning("Unable to write partition cache: " + str(e))
+        if temp_name is not None:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
+
+
+def _get_partitions():
+    '''Return list of partitions and the (qinfo, comments, GRES, features)
+    for each partition'''
+    logger = _get_logger()
+    cache_key = None
+    if _use_partition_cache():
+        cache_key = _partition_cache_key()
+        if cache_key is None:
+            logger.warning(
+                "Slurm configuration file not found (configless Slurm?), "
+                "partition information will not be cached")
+        else:
+            cached = _load_partition_cache(cache_key)
+            if cached is not None:
+                return cached
+    queue_list, _ = _get_queues()
+    # sinfo calls are latency bound, so overlap them, but keep the pool small
+    # to avoid flooding slurmctld. map() preserves the partition order.
+    with ThreadPoolExecutor(max_workers=_QUERY_WORKERS) as executor:
+        queue_data = list(executor.map(_gather_queue, queue_list))
+    if cache_key is not None:
+        _save_partition_cache(cache_key, (queue_list, queue_data, ))
+    return (queue_list, queue_data)
+
+
 def build_queue_defs():
     '''Return YAML suitable for configuring queues'''
     logger = _get_logger()
 
     try:
-        queue_list, default = _get_queues()
+        queue_list, queue_data = _get_partitions()
     except BadSubmission as e:
         logger.error('Unable to query SLURM: ' + str(e))
         return ('', [])
     q_base = CommentedMap()
     q_base['queues'] = CommentedMap()
     queues = q_base['queues']
-    for q in queue_list:
-        qinfo, comments = _get_queue_info(q)
-        gres = _get_queue_gres(q)
-        features = _get_queue_features(q)
+    for q, (qinfo, comments, gres, features) in zip(queue_list, queue_data):
         queues[qinfo['qname']] = CommentedMap()
         qd = queues[qinfo['qname']]
         queues.yaml_add_eol_comment("Queue name", qinfo['qname'], column=0)
-        add_key_comment = qd.yaml_add_eol_comment
         for coproc_m in ('gpu', 'cuda', 'phi', ):
             if coproc_m in q:
                 _add_comment(
@@ -1071,16 +1253,19 @@ def build_queue_defs():
                     " Cannot auto-configure.'"
                 )
         qd['time'] = qinfo['qtime']
-        add_key_comment('Maximum job run time in minutes', 'time', column=0)
         qd['max_slots'] = qinfo['cpus']
-        add_key_comment("Maximum number of threads/slots on a queue", 'max_slots', column=0)
         qd['max_size'] = qinfo['memory']
-        add_key_comment("Maximum RAM size of a job in " + fsl_sub.consts.RAMUNITS + 'B', 'max_size', column=0)
         qd['slot_size'] = None
-        add_key_comment(
-            "Slot size is normally irrelevant on SLURM "
-            "- set this to memory (in {0}B) per thread if required".format(fsl_sub.consts.RAMUNITS),
-            'slot_size')
+        # Comments are collected and applied in one pass once the queue is complete
+        key_comments = [
+            ('time', 'Maximum job run time in minutes', 0, ),
+            ('max_slots', "Maximum number of threads/slots on a queue", 0, ),
+            ('max_size', "Maximum RAM size of a job in " + fsl_sub.consts.RAMUNITS + 'B', 0, ),
+            ('slot_size',
+                "Slot size is normally irrelevant on SLURM "
+                "- set this to memory (in {0}B) per thread if required".format(fsl_sub.consts.RAMUNITS),
+                None, ),
+        ]
         if 'gpu' in gres.keys():
 
             _add_comment(
@@ -1108,7 +1293,7 @@ def build_queue_defs():
                             "and associated class 'resource's would be {1}".format(
                                 constraint, ','.join(options))
                         )
-            qty = max([q[1] for q in gres['gpu']])
+            qty = max(map(itemgetter(1), gres['gpu']))
             _add_comment(comments, 'copros:')
             _add_comment(comments, '  cuda: # CUDA Co-processor available')
             _add_comment(comments, '    max_quantity: ' + str(qty) + ' # Maximum available per node')
@@ -1121,7 +1306,8 @@ def build_queue_defs():
         _add_comment(comments, 'priority: 1 # Priority in group - higher wins')
         _add_comment(comments, 'group: 1 # Group partitions with the same integer then order by priority')
 
-        for w in comments:
-            queues.yaml_set_comment_before_after_key(qinfo['qname'], after=w)
+        for key, comment, column in key_comments:
+            qd.yaml_add_eol_comment(comment, key, column=column)
+        queues.yaml_set_comment_before_after_key(qinfo['qname'], after='\n'.join(comments))
 
     return q_base
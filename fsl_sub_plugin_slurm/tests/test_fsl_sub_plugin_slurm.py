@@ -1,76 +1,89 @@
 #!/usr/bin/env python
-import copy
 import datetime
 import io
 import os
+import pickle
 import subprocess
 import tempfile
+import threading
 import unittest
 import fsl_sub_plugin_slurm
 
 from collections import defaultdict
+from contextlib import ExitStack
 from ruamel.yaml import YAML
 from unittest.mock import (patch, )
 
 import fsl_sub.consts
 from fsl_sub.exceptions import (
     BadSubmission,
+    GridOutputError,
     UnknownJobId
 )
 from fsl_sub.utils import (
     yaml_repr_none,
 )
 
-conf_dict = YAML(typ='safe').load('''---
-method_opts:
-    slurm:
-        memory_in_gb: False
-        queues: True
-        copy_environment: True
-        mail_support: True
-        mail_modes:
-            b:
-                - BEGIN
-            e:
-                - END
-            a:
-                - FAIL
-                - REQUEUE
-            f:
-                - ALL
-            n:
-                - NONE
-        mail_mode: a
-        set_time_limit: False
-        array_holds: True
-        array_limit: True
-        preserve_modules: True
-        add_module_paths: []
-        keep_jobscript: False
-copro_opts:
-    cuda:
-        resource: gpu
-        classes: True
-        class_resource: gputype
-        class_types:
-            K:
-                resource: k80
-                doc: Kepler. ECC, double- or single-precision workloads
-                capability: 2
-            P:
-                resource: p100
-                doc: >
-                    Pascal. ECC, double-, single- and half-precision
-                    workloads
-                capability: 3
-        default_class: K
-        include_more_capable: True
-        uses_modules: True
-        module_parent: cuda
-        no_binding: True
-        class_constriant: True
-''')
+conf_dict = {
+    'method_opts': {
+        'slurm': {
+            'memory_in_gb': False,
+            'queues': True,
+            'copy_environment': True,
+            'mail_support': True,
+            'mail_modes': {
+                'b': ['BEGIN', ],
+                'e': ['END', ],
+                'a': ['FAIL', 'REQUEUE', ],
+                'f': ['ALL', ],
+                'n': ['NONE', ],
+            },
+            'mail_mode': 'a',
+            'set_time_limit': False,
+            'array_holds': True,
+            'array_limit': True,
+            'preserve_modules': True,
+            'add_module_paths': [],
+            'keep_jobscript': False,
+        },
+    },
+    'copro_opts': {
+        'cuda': {
+            'resource': 'gpu',
+            'classes': True,
+            'class_resource': 'gputype',
+            'class_types': {
+                'K': {
+                    'resource': 'k80',
+                    'doc': 'Kepler. ECC, double- or single-precision workloads',
+                    'capability': 2,
+                },
+                'P': {
+                    'resource': 'p100',
+                    'doc': 'Pascal. ECC, double-, single- and half-precision workloads\n',
+                    'capability': 3,
+                },
+            },
+            'default_class': 'K',
+            'include_more_capable': True,
+            'uses_modules': True,
+            'module_parent': 'cuda',
+            'no_binding': True,
+            'class_constriant': True,
+        },
+    },
+}
 mconf_dict = conf_dict['method_opts']['slurm']
+# Variables always exported to Slurm jobs
+ARRAY_EXPORTS = (
+    'FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'
+    'FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'
+    'FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'
+    'FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'
+    'FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'
+    'FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'
+    'FSLSUB_NSLOTS=SLURM_NPROCS'
+)
 
 
 class TestSlurmUtils(unittest.TestCase):
@@ -81,52 +94,55 @@ class TestSlurmUtils(unittest.TestCase):
         )
 
     def test__sacct_timstamp_seconds(self):
-        self.assertEqual(
-            fsl_sub_plugin_slurm._sacct_timestamp_seconds('10:10:10.10'),
-            36610.1
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._sacct_timestamp_seconds('5-10:10:10.10'),
-            468610.1
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._sacct_timestamp_seconds('1:10.10'),
-            70.1
-        )
+        for timestamp, seconds in (
+                ('10:10:10.10', 36610.1),
+                ('5-10:10:10.10', 468610.1),
+                ('1:10.10', 70.1),
+                ('10.5', 10.5),
+                ('Unknown', None), ):
+            with self.subTest(timestamp):
+                self.assertEqual(
+                    fsl_sub_plugin_slurm._sacct_timestamp_seconds(timestamp),
+                    seconds
+                )
+        with self.subTest("Invalid"):
+            self.assertRaises(
+                ValueError,
+                fsl_sub_plugin_slurm._sacct_timestamp_seconds,
+                '1-2-3'
+            )
 
     def test__day_time_minutes(self):
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('1-00:00:00'),
-            24 * 60
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('1-00:01:00'),
-            24 * 60 + 1
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('0-00:01:00'),
-            1
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('0-00:00:01'),
-            1
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('0-01:00:00'),
-            60
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('0-01:01:00'),
-            60 + 1
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('10:00'),
-            10
-        )
-        self.assertEqual(
-            fsl_sub_plugin_slurm._day_time_minutes('10'),
-            1
-        )
+        for dayt, minutes in (
+                ('1-00:00:00', 24 * 60),
+                ('1-00:01:00', 24 * 60 + 1),
+                ('0-00:01:00', 1),
+                ('0-00:00:01', 1),
+                ('0-01:00:00', 60),
+                ('0-01:01:00', 60 + 1),
+                ('10:00', 10),
+                ('10', 1), ):
+            with self.subTest(dayt):
+                self.assertEqual(
+                    fsl_sub_plugin_slurm._day_time_minutes(dayt),
+                    minutes
+                )
+
+    def test__count_lines(self):
+        for content, lines in (
+                (b'', 0),
+                (b'cmd1\n', 1),
+                (b'cmd1\ncmd2\ncmd3\n', 3),
+                (b'cmd1\ncmd2', 2),
+                (b'cmd\n' * 20000, 20000), ):
+            with self.subTest(lines=lines):
+                with tempfile.NamedTemporaryFile(delete=False) as task_f:
+                    task_f.write(content)
+                self.addCleanup(os.unlink, task_f.name)
+                self.assertEqual(
+                    fsl_sub_plugin_slurm._count_lines(task_f.name),
+                    lines
+                )
 
     def test__add_comment(self):
         comments = []
@@ -148,7 +164,34 @@ class TestSlurmUtils(unittest.TestCase):
         )
 
 
+def clear_cmd_caches():
+    '''Forget the cached locations of the Slurm commands'''
+    for cmd in (
+            fsl_sub_plugin_slurm._sinfo_cmd,
+            fsl_sub_plugin_slurm._qsub_cmd,
+            fsl_sub_plugin_slurm._sacctmgr_cmd,
+            fsl_sub_plugin_slurm._sacct_cmd,
+            fsl_sub_plugin_slurm._squeue_cmd,
+            fsl_sub_plugin_slurm._scancel_cmd, ):
+        cmd.cache_clear()
+
+
+def completed(stdout):
+    '''Create a successful sp.run result with the given output'''
+    return subprocess.CompletedProcess([], 0, stdout=stdout, stderr=None)
+
+
+def sacct_result(stdout='', stderr='', returncode=0):
+    '''Create an sp.run result for sacct with the given output'''
+    return subprocess.CompletedProcess(
+        ['sacct'], returncode, stdout=stdout, stderr=stderr)
+
+
 class TestslurmFinders(unittest.TestCase):
+    def setUp(self):
+        clear_cmd_caches()
+        self.addCleanup(clear_cmd_caches)
+
     @patch('fsl_sub_plugin_slurm.which', autospec=True)
     def test_qstat(self, mock_which):
         bin_path = '/usr/bin/squeue'
@@ -159,6 +202,7 @@ class TestslurmFinders(unittest.TestCase):
                 fsl_sub_plugin_slurm._squeue_cmd()
             )
         mock_which.reset_mock()
+        clear_cmd_caches()
         with self.subTest("Test 2"):
             mock_which.return_value = None
             self.assertRaises(
@@ -176,6 +220,7 @@ class TestslurmFinders(unittest.TestCase):
                 fsl_sub_plugin_slurm._qsub_cmd()
             )
         mock_which.reset_mock()
+        clear_cmd_caches()
         with self.subTest("Test 2"):
             mock_which.return_value = None
             self.assertRaises(
@@ -183,372 +228,326 @@ class TestslurmFinders(unittest.TestCase):
                 fsl_sub_plugin_slurm._qsub_cmd
             )
 
+    @patch('fsl_sub_plugin_slurm.which', autospec=True)
     @patch('fsl_sub_plugin_slurm.sp.run', autospec=True)
-    def test_queue_exists(self, mock_spr):
+    def test_queue_exists(self, mock_spr, mock_which):
         bin_path = '/usr/bin/sinfo'
         qname = 'myq'
-        with patch(
-            'fsl_sub_plugin_slurm.which',
-            autospec=True,
-            return_value=None
-        ):
-            with self.subTest("No sinfo"):
-                self.assertRaises(
-                    BadSubmission,
-                    fsl_sub_plugin_slurm.queue_exists,
-                    '123'
-                )
+        with self.subTest("No sinfo"):
+            mock_which.return_value = None
+            self.assertRaises(
+                BadSubmission,
+                fsl_sub_plugin_slurm.queue_exists,
+                '123'
+            )
         mock_spr.reset_mock()
+        clear_cmd_caches()
+        mock_which.return_value = bin_path
+        with self.subTest("Test 1"):
+            mock_spr.return_value = completed('')
+            self.assertFalse(
+                fsl_sub_plugin_slurm.queue_exists(qname)
+            )
+            mock_spr.assert_called_once_with(
+                [bin_path, '--noheader', '-p', qname, '-o', '%P'],
+                stdout=subprocess.PIPE,
+                check=True,
+                universal_newlines=True)
+        mock_spr.reset_mock()
+        with self.subTest("Test 2"):
+            mock_spr.return_value = completed('myq*\n')
+            self.assertTrue(
+                fsl_sub_plugin_slurm.queue_exists(qname, bin_path)
+            )
+        mock_spr.reset_mock()
+        with self.subTest("Multiple queues"):
+            mock_spr.return_value = completed('myq*\n')
+            self.assertFalse(
+                fsl_sub_plugin_slurm.queue_exists('myq@host1,otherq', bin_path)
+            )
+            mock_spr.assert_called_once_with(
+                [bin_path, '--noheader', '-p', 'myq,otherq', '-o', '%P'],
+                stdout=subprocess.PIPE,
+                check=True,
+                universal_newlines=True)
+            mock_spr.return_value = completed('myq*\notherq\n')
+            self.assertTrue(
+                fsl_sub_plugin_slurm.queue_exists('myq@host1,otherq', bin_path)
+            )
+
+    @patch('fsl_sub_plugin_slurm.sp.run', autospec=True)
+    def test_project_list(self, mock_spr):
+        bin_path = '/usr/bin/sacctmgr'
         with patch(
                 'fsl_sub_plugin_slurm.which',
                 return_value=bin_path):
-
-            with self.subTest("Test 1"):
-                mock_spr.return_value = subprocess.CompletedProcess(
-                    [bin_path, '--noheader', '-p', qname],
-                    stdout='',
-                    returncode=0
-                )
-                self.assertFalse(
-                    fsl_sub_plugin_slurm.queue_exists(qname)
-                )
-                mock_spr.assert_called_once_with(
-                    [bin_path, '--noheader', '-p', qname],
-                    stdout=subprocess.PIPE,
-                    check=True,
-                    universal_newlines=True)
-            mock_spr.reset_mock()
-            with self.subTest("Test 2"):
-                mock_spr.return_value = subprocess.CompletedProcess(
-                    [bin_path, '--noheader', '-p', qname],
-                    stdout='A   up  5-00:00:00  1   idle    anode1234\n',
-                    returncode=0
-                )
-                self.assertTrue(
-                    fsl_sub_plugin_slurm.queue_exists(qname, bin_path)
-                )
+            mock_spr.return_value = completed('root|default root account|root\nproja|Project A|unit1\n')
+            self.assertListEqual(
+                fsl_sub_plugin_slurm.project_list(),
+                ['root', 'proja', ]
+            )
+            mock_spr.assert_called_once_with(
+                [bin_path, '-P', '-r', '-n', 'list', 'Account', ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+                universal_newlines=True)
 
 
-@patch('fsl_sub.utils.VERSION', '1.0.0')
-@patch(
-    'fsl_sub_plugin_slurm.os.getcwd',
-    autospec=True, return_value='/Users/testuser')
-@patch(
-    'fsl_sub_plugin_slurm._qsub_cmd',
-    autospec=True, return_value='/usr/bin/sbatch'
-)
-@patch('fsl_sub_plugin_slurm.split_ram_by_slots', autospec=True)
-@patch('fsl_sub_plugin_slurm.coprocessor_config', autospec=True)
-@patch('fsl_sub_plugin_slurm.sp.run', autospec=True)
 class TestSubmit(unittest.TestCase):
+    patch_objects = {
+        'fsl_sub_plugin_slurm.os.getcwd': {'return_value': '/Users/testuser', },
+        'fsl_sub_plugin_slurm._qsub_cmd': {'return_value': '/usr/bin/sbatch', },
+        'fsl_sub_plugin_slurm.split_ram_by_slots': {'autospec': True, },
+        'fsl_sub_plugin_slurm.coprocessor_config': {'autospec': True, },
+        'fsl_sub_plugin_slurm.sp.run': {'autospec': True, },
+        'fsl_sub.utils.datetime': {'autospec': True, },
+        'fsl_sub_plugin_slurm.plugin_version': {'return_value': '2.0.0', },
+        'fsl_sub_plugin_slurm.loaded_modules': {'return_value': ['mymodule', ], },
+        'fsl_sub_plugin_slurm.write_wrapper': {},
+        'fsl_sub_plugin_slurm.method_config': {},
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        # Start the shared patches once for the class, they are reset for each test.
+        # If anything here fails the ExitStack stops the patches already started,
+        # as tearDownClass won't run
+        with ExitStack() as stack:
+            cls.mocks = {
+                p: stack.enter_context(patch(p, **kwargs)) for p, kwargs in cls.patch_objects.items()}
+            stack.enter_context(patch('fsl_sub.utils.VERSION', '1.0.0'))
+            # Command line recorded in the job scripts, tests submitting other commands patch their own
+            stack.enter_context(patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', ] + cls.cmd))
+            cls.bash = '/bin/bash'
+            stack.enter_context(patch.dict(os.environ, {'FSLSUB_SHELL': cls.bash}))
+            # Submission time recorded in the job scripts
+            cls.now = datetime.datetime.now()
+            cls.now_str = cls.now.strftime("%H:%M:%S %d/%m/%Y")
+            # Wrapper content is read from the mock's call, but fix_permissions needs a real file
+            wrapper_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            cls.wrapper_name = os.path.join(wrapper_dir, 'wrapper.sh')
+            open(cls.wrapper_name, 'w').close()
+            cls.class_cleanup = stack.pop_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.class_cleanup.close()
+
     def setUp(self):
-        self.ww = tempfile.NamedTemporaryFile(
-            mode='w+t',
-            delete=False)
-        self.now = datetime.datetime.now()
-        self.strftime = datetime.datetime.strftime
-        self.bash = '/bin/bash'
-        os.environ['FSLSUB_SHELL'] = self.bash
-        self.config = copy.deepcopy(conf_dict)
-        self.mconfig = self.config['method_opts']['slurm']
-        self.patch_objects = {
-            'fsl_sub.utils.datetime': {'autospec': True, },
-            'fsl_sub_plugin_slurm.plugin_version': {'autospec': True, 'return_value': '2.0.0', },
-            'fsl_sub_plugin_slurm.loaded_modules': {'autospec': True, 'return_value': ['mymodule', ], },
-            'fsl_sub_plugin_slurm.write_wrapper': {'autospec': True, 'side_effect': self.w_wrapper},
-            'fsl_sub_plugin_slurm.method_config': {'autospec': True, 'return_value': self.mconfig, },
-        }
-        self.patch_dict_objects = {}
-        self.patches = {}
-        for p, kwargs in self.patch_objects.items():
-            self.patches[p] = patch(p, **kwargs)
-        self.mocks = {}
-        for o, p in self.patches.items():
-            self.mocks[o] = p.start()
-
-        self.dict_patches = {}
-        for p, kwargs in self.patch_dict_objects.items():
-            self.dict_patches[p] = patch.dict(p, **kwargs)
-
-        for o, p in self.dict_patches.items():
-            self.mocks[o] = p.start()
+        for mock in self.mocks.values():
+            mock.reset_mock()
+        self.mock_sprun = self.mocks['fsl_sub_plugin_slurm.sp.run']
+        self.mock_cpconf = self.mocks['fsl_sub_plugin_slurm.coprocessor_config']
+        self.mocks['fsl_sub_plugin_slurm.loaded_modules'].return_value = ['mymodule', ]
+        self.mocks['fsl_sub_plugin_slurm.write_wrapper'].return_value = self.wrapper_name
+        self.set_method_config()
         self.mocks['fsl_sub.utils.datetime'].datetime.now.return_value = self.now
-        self.mocks['fsl_sub.utils.datetime'].datetime.strftime = self.strftime
-        self.addCleanup(patch.stopall)
-
-    def TearDown(self):
-        self.ww.close()
-        os.unlink(self.ww.name)
-        patch.stopall()
+        self.mocks['fsl_sub.utils.datetime'].datetime.strftime = datetime.datetime.strftime
 
     plugin = fsl_sub_plugin_slurm
 
-    def w_wrapper(self, content):
-        for lf in content:
-            self.ww.write(lf + '\n')
-        return self.ww.name
+    mconfig = mconf_dict
+    cuda_config = conf_dict['copro_opts']['cuda']
+
+    def set_method_config(self, **overrides):
+        '''Give the plugin the test method configuration with the keys in overrides replaced'''
+        self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = dict(self.mconfig, **overrides)
+
+    job_name = 'test_job'
+    cmd = ['./acmd', 'arg1', 'arg2', ]
+    cmd_str = ' '.join(cmd)
+
+    def expected_script(
+            self, queue='a.q', command_line=None, exports=('ALL', ),
+            constraint=None, gres=None, log_suffix='%j', hosts=None,
+            project=None, array=None, module_paths=None, threads=None,
+            mailto=None, mail_type=None):
+        '''Build the lines of the job script expected when submitting self.cmd.
+        command_line holds the fsl_sub options preceding the command, defaulting
+        to selecting queue'''
+        logs = os.path.join(os.getcwd(), self.job_name)
+        if command_line is None:
+            command_line = ['-q', queue, ]
+        lines = ['#!' + self.bash, '', ]
+        if threads is not None:
+            lines.append('#SBATCH --ntasks-per-node={0}'.format(threads))
+        lines.append('#SBATCH --export=' + ','.join(list(exports) + [ARRAY_EXPORTS, ]))
+        if constraint is not None:
+            lines.append('#SBATCH --constraint="{0}"'.format(constraint))
+        if gres is not None:
+            lines.append('#SBATCH --gres=' + gres)
+        lines.extend([
+            '#SBATCH -o {0}.o{1}'.format(logs, log_suffix),
+            '#SBATCH -e {0}.e{1}'.format(logs, log_suffix),
+        ])
+        if mailto is not None:
+            lines.append('#SBATCH --mail-user=' + mailto)
+            lines.append('#SBATCH --mail-type=' + mail_type)
+        lines.extend([
+            '#SBATCH --job-name=' + self.job_name,
+            '#SBATCH --chdir=' + os.getcwd(),
+            '#SBATCH -p ' + ','.join(q.partition('@')[0] for q in queue.split(',')),
+        ])
+        if hosts is not None:
+            lines.append('#SBATCH -w ' + hosts)
+        lines.extend([
+            '#SBATCH --parsable',
+            '#SBATCH --requeue',
+        ])
+        if project is not None:
+            lines.append('#SBATCH --account ' + project)
+        if array is not None:
+            lines.append('#SBATCH --array=' + array)
+        if module_paths is not None:
+            lines.append('MODULEPATH=' + ':'.join(module_paths + ['$MODULEPATH', ]))
+        lines.extend([
+            'module load mymodule',
+            '# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0',
+            '# Command line: ' + ' '.join(['fsl_sub', ] + command_line + [self.cmd_str, ]),
+            '# Submission time (H:M:S DD/MM/YYYY): ' + self.now_str,
+            '',
+            self.cmd_str,
+            '',
+        ])
+        return lines
 
-    def test_empty_submit(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
+    def test_empty_submit(self):
         self.assertRaises(
             self.plugin.BadSubmission,
             self.plugin.submit,
             None, None, None
         )
 
-    def test_submit_basic(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
-        queue = 'a.q'
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+    def test_submit_queues(self):
         jid = 12345
         qsub_out = str(jid)
-        with self.subTest("Slurm"):
-            expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={5}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {3}
-# Submission time (H:M:S DD/MM/YYYY): {4}
-
-{3}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, queue, ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir)
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-                self.assertEqual(
-                    jid,
-                    self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=queue
+        expected_cmd = ['/usr/bin/sbatch']
+        for name, queue, hosts in (
+                ("Single queue", 'a.q', None),
+                ("Single host", 'a.q@host1', 'host1'),
+                ("Multiple queues", 'a.q,b.q', None),
+                ("Multiple queues, one host", 'a.q@host1,b.q', 'host1'),
+                ("Multiple queues and hosts", 'a.q@host1,b.q@host2', 'host1,host2'), ):
+            self.mock_sprun.reset_mock()
+            with self.subTest(name):
+                expected_script = '\n'.join(self.expected_script(queue, hosts=hosts))
+                self.mock_sprun.return_value = completed(qsub_out)
+                with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', queue, ] + self.cmd):
+                    self.assertEqual(
+                        jid,
+                        self.plugin.submit(
+                            command=self.cmd,
+                            job_name=self.job_name,
+                            queue=queue
+                        )
                     )
+                self.mock_sprun.assert_called_once_with(
+                    expected_cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    input=expected_script
                 )
-            mock_sprun.assert_called_once_with(
-                expected_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                input=expected_script
-            )
 
-    def test_submit_singlehost(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
-        queue = 'a.q@host1'
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+    def test_submit_parallel_env(self):
         jid = 12345
-        qsub_out = str(jid)
-        with self.subTest("Slurm"):
-            expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={7}
-#SBATCH -p {2}
-#SBATCH -w {5}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {6} {3}
-# Submission time (H:M:S DD/MM/YYYY): {4}
-
-{3}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, 'a.q', ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    'host1',
-                    queue,
-                    logdir)
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', queue, './acmd', 'arg1', 'arg2']):
+        self.mock_sprun.return_value = completed(str(jid))
+        for threads in (1, 4, ):
+            self.mock_sprun.reset_mock()
+            with self.subTest("{0} threads".format(threads)):
+                expected_script = '\n'.join(self.expected_script(threads=threads))
                 self.assertEqual(
                     jid,
                     self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=queue
+                        command=self.cmd,
+                        job_name=self.job_name,
+                        queue='a.q',
+                        parallel_env='shmem',
+                        threads=threads
                     )
                 )
-            mock_sprun.assert_called_once_with(
-                expected_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                input=expected_script
-            )
+                self.mock_sprun.assert_called_once_with(
+                    ['/usr/bin/sbatch'],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    input=expected_script
+                )
 
-    def test_submit_multiq(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
-        queue = ['a.q', 'b.q', ]
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+    def test_submit_mail(self):
         jid = 12345
-        qsub_out = str(jid)
-        with self.subTest("Slurm"):
-            expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={5}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {3}
-# Submission time (H:M:S DD/MM/YYYY): {4}
-
-{3}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, ','.join(queue), ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir
+        mailto = 'user@example.com'
+        self.mock_sprun.return_value = completed(str(jid))
+        with self.subTest("Mail address"):
+            expected_script = '\n'.join(self.expected_script(
+                mailto=mailto, mail_type='FAIL,REQUEUE'))
+            self.assertEqual(
+                jid,
+                self.plugin.submit(
+                    command=self.cmd,
+                    job_name=self.job_name,
+                    queue='a.q',
+                    mailto=mailto
                 )
             )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', ','.join(queue), './acmd', 'arg1', 'arg2']):
-                self.assertEqual(
-                    jid,
-                    self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=','.join(queue)
-                    )
-                )
-            mock_sprun.assert_called_once_with(
-                expected_cmd,
+            self.mock_sprun.assert_called_once_with(
+                ['/usr/bin/sbatch'],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
                 input=expected_script
             )
+        self.assertEqual(self.mconfig['mail_mode'], 'a')
+        self.assertListEqual(self.mconfig['mail_modes']['a'], ['FAIL', 'REQUEUE', ])
+        for name, mail_on, mail_type in (
+                ("Default mail mode", None, 'FAIL,REQUEUE'),
+                ("Mail on end", 'e', 'END'), ):
+            self.mock_sprun.reset_mock()
+            with self.subTest(name):
+                self.plugin.submit(
+                    command=self.cmd,
+                    job_name=self.job_name,
+                    queue='a.q',
+                    mailto=mailto,
+                    mail_on=mail_on
+                )
+                script_lines = self.mock_sprun.call_args[1]['input'].splitlines()
+                self.assertIn('#SBATCH --mail-type=' + mail_type, script_lines)
+        with self.subTest("Unknown mail mode"):
+            self.assertRaises(
+                BadSubmission,
+                self.plugin.submit,
+                command=self.cmd,
+                job_name=self.job_name,
+                queue='a.q',
+                mailto=mailto,
+                mail_on='x'
+            )
 
-    def test_submit_multiq_multih(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
-        queue = ['a.q@host1', 'b.q', ]
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+    def test_submit_array_specifier(self):
+        job_name = self.job_name
+        queue = 'a.q'
+        cmd = self.cmd
         jid = 12345
         qsub_out = str(jid)
         with self.subTest("Slurm"):
             expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={7}
-#SBATCH -p {5}
-#SBATCH -w {4}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {6} {2}
-# Submission time (H:M:S DD/MM/YYYY): {3}
-
-{2}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name,
-                    ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    'host1',
-                    'a.q,b.q',
-                    ','.join(queue),
-                    logdir
-                )
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', ','.join(queue), './acmd', 'arg1', 'arg2']):
+            expected_script = '\n'.join(self.expected_script(
+                queue, command_line=['-q', queue, '-t', ], log_suffix='%A.%a', array='1-8:2'))
+            self.mock_sprun.return_value = completed(qsub_out)
+            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', '-t', './acmd', 'arg1', 'arg2']):
                 self.assertEqual(
                     jid,
                     self.plugin.submit(
                         command=cmd,
                         job_name=job_name,
-                        queue=','.join(queue)
+                        queue=queue,
+                        array_task=True,
+                        array_specifier='1-8:2'
                     )
                 )
-            mock_sprun.assert_called_once_with(
+            self.mock_sprun.assert_called_once_with(
                 expected_cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
@@ -556,372 +555,96 @@ module load mymodule
                 input=expected_script
             )
 
-    def test_submit_multiq_multih2(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
-        queue = ['a.q@host1', 'b.q@host2', ]
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
-        jid = 12345
-        qsub_out = str(jid)
-        with self.subTest("Slurm"):
-            expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={7}
-#SBATCH -p {2}
-#SBATCH -w {5}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {6} {3}
-# Submission time (H:M:S DD/MM/YYYY): {4}
-
-{3}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, ','.join([q.split('@')[0] for q in queue]),
-                    ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    'host1,host2',
-                    ','.join(queue),
-                    logdir
-                )
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', ','.join(queue), './acmd', 'arg1', 'arg2']):
-                self.assertEqual(
-                    jid,
+    def test_submit_array_limit(self):
+        self.mock_sprun.return_value = completed('12345')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            task_file = os.path.join(tmpdir, 'tasks')
+            with open(task_file, 'w') as task_f:
+                task_f.write('./acmd 1\n./acmd 2\n./acmd 3\n')
+            for name, array_limit_conf, expected_array in (
+                    ("Limited", True, '--array=1-3%2'),
+                    ("Limits disabled", False, '--array=1-3'), ):
+                self.mock_sprun.reset_mock()
+                with self.subTest(name):
+                    self.set_method_config(array_limit=array_limit_conf)
                     self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=','.join(queue)
+                        command=[task_file, ],
+                        job_name=self.job_name,
+                        queue='a.q',
+                        array_task=True,
+                        array_limit=2
                     )
-                )
-            mock_sprun.assert_called_once_with(
-                expected_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                input=expected_script
-            )
+                    array_lines = [
+                        line for line in self.mock_sprun.call_args[1]['input'].splitlines()
+                        if line.startswith('#SBATCH --array')]
+                    self.assertListEqual(array_lines, ['#SBATCH ' + expected_array, ])
 
-    def test_project_submit(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
+    def test_project_submit(self):
+        job_name = self.job_name
         queue = 'a.q'
         project = 'Aproject'
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+        cmd = self.cmd
         jid = 12345
         qsub_out = str(jid)
         with self.subTest("No projects"):
-            w_conf = copy.deepcopy(self.config)
-            w_conf['method_opts']['slurm']['projects'] = True
-            self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
+            self.set_method_config(projects=True)
             expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={5}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {3}
-# Submission time (H:M:S DD/MM/YYYY): {4}
-
-{3}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, queue, ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir
+            expected_script = '\n'.join(self.expected_script(queue))
+            self.mock_sprun.return_value = completed(qsub_out)
+            self.assertEqual(
+                jid,
+                self.plugin.submit(
+                    command=cmd,
+                    job_name=job_name,
+                    queue=queue
                 )
             )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-                self.assertEqual(
-                    jid,
-                    self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=queue
-                    )
-                )
-            mock_sprun.assert_called_once_with(
+            self.mock_sprun.assert_called_once_with(
                 expected_cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
                 input=expected_script
             )
-        mock_sprun.reset_mock()
-        self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = mconf_dict
+        self.mock_sprun.reset_mock()
+        self.set_method_config()
         with self.subTest("With Project"):
             expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={6}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-#SBATCH --account {3}
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {4}
-# Submission time (H:M:S DD/MM/YYYY): {5}
-
-{4}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, queue, project, ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir)
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-                self.assertEqual(
-                    jid,
-                    self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=queue,
-                        project='Aproject'
-                    )
-                )
-            mock_sprun.assert_called_once_with(
-                expected_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                input=expected_script
-            )
-        mock_sprun.reset_mock()
-        with self.subTest("With modules path"):
-            w_conf = copy.deepcopy(self.config)
-            w_conf['method_opts']['slurm']['projects'] = True
-            w_conf['method_opts']['slurm']['add_module_paths'] = ['/usr/local/shellmodules']
-            self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
-            expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={6}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-#SBATCH --account {3}
-MODULEPATH=/usr/local/shellmodules:$MODULEPATH
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {4}
-# Submission time (H:M:S DD/MM/YYYY): {5}
-
-{4}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, queue, project, ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir)
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-                self.assertEqual(
-                    jid,
-                    self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=queue,
-                        project='Aproject'
-                    )
-                )
-            mock_sprun.assert_called_once_with(
-                expected_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                input=expected_script
-            )
-
-        mock_sprun.reset_mock()
-        with self.subTest("GPU without constraints"):
-            w_conf = copy.deepcopy(self.config)
-            w_conf['method_opts']['slurm']['projects'] = True
-            w_conf['method_opts']['slurm']['add_module_paths'] = ['/usr/local/shellmodules']
-            w_conf['copro_opts']['cuda']['class_constraint'] = False
-            self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
-            mock_cpconf.return_value = w_conf['copro_opts']['cuda']
-            expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH --gres=gpu:k80:1
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={6}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-#SBATCH --account {3}
-MODULEPATH=/usr/local/shellmodules:$MODULEPATH
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {4}
-# Submission time (H:M:S DD/MM/YYYY): {5}
-
-{4}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, queue, project, ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir)
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-                job_id = self.plugin.submit(
+            expected_script = '\n'.join(self.expected_script(queue, project=project))
+            self.mock_sprun.return_value = completed(qsub_out)
+            self.assertEqual(
+                jid,
+                self.plugin.submit(
                     command=cmd,
                     job_name=job_name,
                     queue=queue,
-                    project='Aproject',
-                    coprocessor='cuda'
+                    project='Aproject'
                 )
-                self.assertEqual(jid, job_id)
-            mock_sprun.assert_called_once_with(
+            )
+            self.mock_sprun.assert_called_once_with(
                 expected_cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
                 input=expected_script
             )
-
-        mock_sprun.reset_mock()
-        mock_sprun.reset_mock()
-        with self.subTest("GPU without constraints"):
-            w_conf = copy.deepcopy(self.config)
-            w_conf['method_opts']['slurm']['projects'] = True
-            w_conf['method_opts']['slurm']['add_module_paths'] = ['/usr/local/shellmodules']
-            w_conf['copro_opts']['cuda']['classes'] = False
-            self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
-            mock_cpconf.return_value = w_conf['copro_opts']['cuda']
+        self.mock_sprun.reset_mock()
+        with self.subTest("With modules path"):
+            self.set_method_config(projects=True, add_module_paths=['/usr/local/shellmodules'])
             expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH --gres=gpu:1
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={6}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-#SBATCH --account {3}
-MODULEPATH=/usr/local/shellmodules:$MODULEPATH
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {4}
-# Submission time (H:M:S DD/MM/YYYY): {5}
-
-{4}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, queue, project, ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir)
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-                job_id = self.plugin.submit(
+            expected_script = '\n'.join(self.expected_script(
+                queue, project=project, module_paths=['/usr/local/shellmodules', ]))
+            self.mock_sprun.return_value = completed(qsub_out)
+            self.assertEqual(
+                jid,
+                self.plugin.submit(
                     command=cmd,
                     job_name=job_name,
                     queue=queue,
-                    project='Aproject',
-                    coprocessor='cuda'
+                    project='Aproject'
                 )
-                self.assertEqual(jid, job_id)
-            mock_sprun.assert_called_once_with(
+            )
+            self.mock_sprun.assert_called_once_with(
                 expected_cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
@@ -929,54 +652,20 @@ module load mymodule
                 input=expected_script
             )
 
-        mock_sprun.reset_mock()
-        with self.subTest("With GPU constraints"):
-            w_conf = self.config
-            w_conf['method_opts']['slurm']['projects'] = True
-            w_conf['method_opts']['slurm']['add_module_paths'] = ['/usr/local/shellmodules']
-            w_conf['copro_opts']['cuda']['set_visible'] = True
-            w_conf['copro_opts']['cuda']['class_constraint'] = 'gpu_sku'
-            self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
-            mock_cpconf.return_value = w_conf['copro_opts']['cuda']
-            expected_cmd = ['/usr/bin/sbatch']
-            expected_script = (
-                '#!' + self.bash + '''
-
-#SBATCH --export=ALL,'''
-                '''FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'''
-                '''FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'''
-                '''FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'''
-                '''FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'''
-                '''FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'''
-                '''FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'''
-                '''FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH --constraint="gpu_sku:k80|gpu_sku:p100"
-#SBATCH --gres=gpu:1
-#SBATCH -o {0}.o%j
-#SBATCH -e {0}.e%j
-#SBATCH --job-name={1}
-#SBATCH --chdir={6}
-#SBATCH -p {2}
-#SBATCH --parsable
-#SBATCH --requeue
-#SBATCH --account {3}
-MODULEPATH=/usr/local/shellmodules:$MODULEPATH
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {2} {4}
-# Submission time (H:M:S DD/MM/YYYY): {5}
-
-{4}
-'''.format(
-                    os.path.join(logdir, job_name),
-                    job_name, queue, project, ' '.join(cmd),
-                    self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                    logdir)
-            )
-            mock_sprun.return_value = subprocess.CompletedProcess(
-                expected_cmd, 0,
-                stdout=qsub_out, stderr=None)
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
+        self.set_method_config(projects=True, add_module_paths=['/usr/local/shellmodules'])
+        for name, copro_conf, script_opts in (
+                ("GPU without constraints", {'class_constraint': False}, {'gres': 'gpu:k80:1'}),
+                ("GPU without classes", {'classes': False}, {'gres': 'gpu:1'}),
+                ("With GPU constraints", {'set_visible': True, 'class_constraint': 'gpu_sku'},
+                    {'constraint': 'gpu_sku:k80|gpu_sku:p100', 'gres': 'gpu:1'}), ):
+            self.mock_sprun.reset_mock()
+            with self.subTest(name):
+                self.mock_cpconf.return_value = dict(self.cuda_config, **copro_conf)
+                expected_cmd = ['/usr/bin/sbatch']
+                expected_script = '\n'.join(self.expected_script(
+                    queue, project=project, module_paths=['/usr/local/shellmodules', ],
+                    **script_opts))
+                self.mock_sprun.return_value = completed(qsub_out)
                 job_id = self.plugin.submit(
                     command=cmd,
                     job_name=job_name,
@@ -985,226 +674,130 @@ module load mymodule
                     coprocessor='cuda'
                 )
                 self.assertEqual(jid, job_id)
-            mock_sprun.assert_called_once_with(
-                expected_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                input=expected_script
+                self.mock_sprun.assert_called_once_with(
+                    expected_cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    input=expected_script
+                )
+
+        self.mock_sprun.reset_mock()
+        with self.subTest("With GPU constraints and class"):
+            self.plugin.submit(
+                command=cmd,
+                job_name=job_name,
+                queue=queue,
+                project='Aproject',
+                coprocessor='cuda',
+                coprocessor_class='P'
             )
+            self.assertIn(
+                '#SBATCH --constraint="gpu_sku:p100"\n',
+                self.mock_sprun.call_args[1]['input'])
 
-    def test_submit_wrapper_set_vars(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
+    def test_submit_wrapper_set_vars(self):
+        job_name = self.job_name
         queue = 'a.q'
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+        cmd = self.cmd
         jid = 12345
         qsub_out = str(jid)
-        w_conf = self.config
-        w_conf['method_opts']['slurm']['use_jobscript'] = True
-        w_conf['method_opts']['slurm']['copy_environment'] = False
-        self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
-        mock_cpconf.return_value = w_conf['copro_opts']['cuda']
+        self.set_method_config(use_jobscript=True, copy_environment=False)
+        self.mock_cpconf.return_value = self.cuda_config
 
         expected_cmd = ['/usr/bin/sbatch']
-        expected_script = (
-            '''#!{0}
-
-#SBATCH --export=FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,\
-FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,\
-FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,\
-FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,\
-FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,\
-FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,\
-FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {1}.o%j
-#SBATCH -e {1}.e%j
-#SBATCH --job-name={2}
-#SBATCH --chdir={6}
-#SBATCH -p {3}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {3} {4}
-# Submission time (H:M:S DD/MM/YYYY): {5}
-
-{4}
-'''.format(
-                self.bash,
-                os.path.join(logdir, job_name),
-                job_name,
-                queue, ' '.join(cmd),
-                self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                logdir)
-        )
-        mock_sprun.return_value = subprocess.CompletedProcess(
-            expected_cmd, 0,
-            stdout=qsub_out, stderr=None)
-        with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-            self.assertEqual(
-                jid,
-                self.plugin.submit(
-                    command=cmd,
-                    job_name=job_name,
-                    queue=queue
-                )
+        expected_script = '\n'.join(self.expected_script(queue, exports=()))
+        self.mock_sprun.return_value = completed(qsub_out)
+        self.assertEqual(
+            jid,
+            self.plugin.submit(
+                command=cmd,
+                job_name=job_name,
+                queue=queue
             )
-        mock_sprun.assert_called_once_with(
+        )
+        self.mock_sprun.assert_called_once_with(
             expected_cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             universal_newlines=True,
             input=expected_script
         )
-        mock_sprun.reset_mock()
+        self.mock_sprun.reset_mock()
 
-    def test_submit_wrapper_set_complex_vars(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
+    def test_submit_wrapper_set_complex_vars(self):
+        job_name = self.job_name
         queue = 'a.q'
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+        cmd = self.cmd
         jid = 12345
         qsub_out = str(jid)
-        w_conf = self.config
-        w_conf['method_opts']['slurm']['use_jobscript'] = True
-        w_conf['method_opts']['slurm']['copy_environment'] = False
-        self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
-        mock_cpconf.return_value = w_conf['copro_opts']['cuda']
+        self.set_method_config(use_jobscript=True, copy_environment=False)
+        self.mock_cpconf.return_value = self.cuda_config
 
         expected_cmd = ['/usr/bin/sbatch']
-        expected_script = (
-            '''#!{0}
-
-#SBATCH --export=AVAR='1,2',BVAR='a b',FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,\
-FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,\
-FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,\
-FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,\
-FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,\
-FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,\
-FSLSUB_NSLOTS=SLURM_NPROCS
-#SBATCH -o {1}.o%j
-#SBATCH -e {1}.e%j
-#SBATCH --job-name={2}
-#SBATCH --chdir={6}
-#SBATCH -p {3}
-#SBATCH --parsable
-#SBATCH --requeue
-module load mymodule
-# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0
-# Command line: fsl_sub -q {3} {4}
-# Submission time (H:M:S DD/MM/YYYY): {5}
-
-{4}
-'''.format(
-                self.bash,
-                os.path.join(logdir, job_name),
-                job_name,
-                queue, ' '.join(cmd),
-                self.now.strftime("%H:%M:%S %d/%m/%Y"),
-                logdir)
-        )
-        mock_sprun.return_value = subprocess.CompletedProcess(
-            expected_cmd, 0,
-            stdout=qsub_out, stderr=None)
-        with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-            self.assertEqual(
-                jid,
-                self.plugin.submit(
-                    command=cmd,
-                    job_name=job_name,
-                    queue=queue,
-                    export_vars=['AVAR=1,2', 'BVAR=a b']
-                )
+        expected_script = '\n'.join(self.expected_script(
+            queue, exports=("AVAR='1,2'", "BVAR='a b'", )))
+        self.mock_sprun.return_value = completed(qsub_out)
+        self.assertEqual(
+            jid,
+            self.plugin.submit(
+                command=cmd,
+                job_name=job_name,
+                queue=queue,
+                export_vars=['AVAR=1,2', 'BVAR=a b']
             )
-        mock_sprun.assert_called_once_with(
+        )
+        self.mock_sprun.assert_called_once_with(
             expected_cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             universal_newlines=True,
             input=expected_script
         )
-        mock_sprun.reset_mock()
+        self.mock_sprun.reset_mock()
 
-    def test_submit_wrapper_keep(
-            self, mock_sprun, mock_cpconf,
-            mock_srbs, mock_qsub,
-            mock_getcwd):
-        job_name = 'test_job'
+    def test_submit_wrapper_keep(self):
+        job_name = self.job_name
         queue = 'a.q'
-        cmd = ['./acmd', 'arg1', 'arg2', ]
-        logdir = os.getcwd()
+        cmd = self.cmd
         jid = 12345
         qsub_out = str(jid)
-        w_conf = self.config
-        w_conf['method_opts']['slurm']['use_jobscript'] = True
-        w_conf['method_opts']['slurm']['copy_environment'] = False
-        self.mocks['fsl_sub_plugin_slurm.method_config'].return_value = w_conf['method_opts']['slurm']
-        mock_cpconf.return_value = w_conf['copro_opts']['cuda']
-
-        expected_cmd = ['/usr/bin/sbatch', self.ww.name]
-        expected_script = [
-            '#!' + self.bash,
-            '',
-            '#SBATCH --export=FSLSUB_JOB_ID_VAR=SLURM_JOB_ID,'
-            'FSLSUB_ARRAYTASKID_VAR=SLURM_ARRAY_TASK_ID,'
-            'FSLSUB_ARRAYSTARTID_VAR=SLURM_ARRAY_TASK_MIN,'
-            'FSLSUB_ARRAYENDID_VAR=SLURM_ARRAY_TASK_MAX,'
-            'FSLSUB_ARRAYSTEPSIZE_VAR=SLURM_ARRAY_TASK_STEP,'
-            'FSLSUB_ARRAYCOUNT_VAR=SLURM_ARRAY_TASK_COUNT,'
-            'FSLSUB_NSLOTS=SLURM_NPROCS',
-            '#SBATCH -o {0}.o%j'.format(os.path.join(logdir, job_name)),
-            '#SBATCH -e {0}.e%j'.format(os.path.join(logdir, job_name)),
-            '#SBATCH --job-name=' + job_name,
-            '#SBATCH --chdir=' + logdir,
-            '#SBATCH -p ' + queue,
-            '#SBATCH --parsable',
-            '#SBATCH --requeue',
-            'module load mymodule',
-            '# Built by fsl_sub v.1.0.0 and fsl_sub_plugin_slurm v.2.0.0',
-            '# Command line: fsl_sub -q {0} {1}'.format(queue, ' '.join(cmd)),
-            '# Submission time (H:M:S DD/MM/YYYY): ' + self.now.strftime("%H:%M:%S %d/%m/%Y"),
-            '',
-            ' '.join(cmd),
-            ''
-        ]
-        mock_sprun.return_value = subprocess.CompletedProcess(
-            expected_cmd, 0,
-            stdout=qsub_out, stderr=None)
+        self.set_method_config(use_jobscript=True, copy_environment=False)
+        self.mock_cpconf.return_value = self.cuda_config
+
+        expected_cmd = ['/usr/bin/sbatch', self.wrapper_name]
+        expected_script = self.expected_script(queue, exports=())
+        self.mock_sprun.return_value = completed(qsub_out)
 
+        mock_getcwd = self.mocks['fsl_sub_plugin_slurm.os.getcwd']
+        mock_getcwd.reset_mock()
         with patch('fsl_sub_plugin_slurm.os.rename') as mock_rename:
-            with patch('fsl_sub.utils.sys.argv', ['fsl_sub', '-q', 'a.q', './acmd', 'arg1', 'arg2']):
-                self.assertEqual(
-                    jid,
-                    self.plugin.submit(
-                        command=cmd,
-                        job_name=job_name,
-                        queue=queue,
-                        keep_jobscript=True
-                    )
+            self.assertEqual(
+                jid,
+                self.plugin.submit(
+                    command=cmd,
+                    job_name=job_name,
+                    queue=queue,
+                    keep_jobscript=True
                 )
-        mock_sprun.assert_called_once_with(
+            )
+        self.mock_sprun.assert_called_once_with(
             expected_cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             universal_newlines=True,
         )
-        mock_sprun.reset_mock()
-        self.ww.seek(0)
-        wrapper_lines = self.ww.read().splitlines()
+        # Log, working and wrapper directories all come from one lookup
+        mock_getcwd.assert_called_once_with()
+        self.mock_sprun.reset_mock()
+        wrapper_lines = self.mocks['fsl_sub_plugin_slurm.write_wrapper'].call_args[0][0]
         self.maxDiff = None
         self.assertListEqual(
             wrapper_lines,
             expected_script
         )
         mock_rename.assert_called_once_with(
-            self.ww.name,
+            self.wrapper_name,
             os.path.join(
                 os.getcwd(),
                 '_'.join(('wrapper', str(jid) + '.sh'))
@@ -1212,7 +805,62 @@ module load mymodule
         )
 
 
+class TestSubmitMany(unittest.TestCase):
+    @patch('fsl_sub_plugin_slurm.submit', autospec=True, return_value=12345)
+    def test_submit_many(self, mock_submit):
+        with tempfile.TemporaryDirectory() as logdir:
+            with self.subTest("Array of commands"):
+                self.assertListEqual(
+                    fsl_sub_plugin_slurm.submit_many(
+                        [['./acmd', '1', ], './acmd 2', ],
+                        'test_job', 'a.q', logdir=logdir, jobram=10),
+                    ['12345_1', '12345_2', ]
+                )
+                (task_file, ), job_name, queue = mock_submit.call_args[0]
+                self.assertEqual(
+                    mock_submit.call_args[1],
+                    {'array_task': True, 'logdir': logdir, 'jobram': 10, })
+                self.assertEqual((job_name, queue), ('test_job', 'a.q', ))
+                self.assertEqual(os.path.dirname(task_file), logdir)
+                with open(task_file, 'r') as task_f:
+                    self.assertEqual(task_f.read(), './acmd 1\n./acmd 2\n')
+            mock_submit.reset_mock()
+            with self.subTest("Logs discarded"):
+                with patch('fsl_sub_plugin_slurm.os.getcwd', return_value=logdir):
+                    fsl_sub_plugin_slurm.submit_many(
+                        ['./acmd 1', ], 'test_job', 'a.q', logdir='/dev/null')
+                (task_file, ), _, _ = mock_submit.call_args[0]
+                self.assertEqual(mock_submit.call_args[1]['logdir'], '/dev/null')
+                self.assertEqual(os.path.dirname(task_file), logdir)
+            mock_submit.reset_mock()
+            with self.subTest("No commands"):
+                self.assertRaises(
+                    BadSubmission,
+                    fsl_sub_plugin_slurm.submit_many,
+                    [], 'test_job', 'a.q', logdir=logdir
+                )
+                mock_submit.assert_not_called()
+            for name, commands, kwargs in (
+                    ("Command with newline", ['./acmd 1', './acmd 2\n./acmd 3', ], {}),
+                    ("Command list with newline", [['./acmd', '1\n2', ], ], {}),
+                    ("Array task", ['./acmd 1', ], {'array_task': True, }),
+                    ("Array specifier", ['./acmd 1', ], {'array_specifier': '1-4', }), ):
+                with self.subTest(name):
+                    self.assertRaises(
+                        BadSubmission,
+                        fsl_sub_plugin_slurm.submit_many,
+                        commands, 'rejected_job', 'a.q', logdir=logdir, **kwargs
+                    )
+                    mock_submit.assert_not_called()
+                    self.assertFalse(
+                        [f for f in os.listdir(logdir) if f.startswith('rejected_job')])
+
+
 class TestQdel(unittest.TestCase):
+    def setUp(self):
+        clear_cmd_caches()
+        self.addCleanup(clear_cmd_caches)
+
     @patch('fsl_sub_plugin_slurm.which', autospec=True)
     @patch('fsl_sub_plugin_slurm.sp.run', autospec=True)
     def testqdel(self, mock_spr, mock_which):
@@ -1234,9 +882,26 @@ class TestQdel(unittest.TestCase):
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT
         )
 
+    @patch('fsl_sub_plugin_slurm.which', autospec=True)
+    @patch('fsl_sub_plugin_slurm.sp.run', autospec=True)
+    def testqdel_many(self, mock_spr, mock_which):
+        mock_which.return_value = '/usr/bin/scancel'
+        mock_spr.return_value = completed('')
+        self.assertTupleEqual(
+            fsl_sub_plugin_slurm.qdel_many([1234, '5678']),
+            ('', 0)
+        )
+        mock_spr.assert_called_once_with(
+            ['/usr/bin/scancel', '1234', '5678'],
+            universal_newlines=True,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+
 
 class TestJobStatus(unittest.TestCase):
     def setUp(self):
+        fsl_sub_plugin_slurm._clear_sacct_cache()
+        self.addCleanup(fsl_sub_plugin_slurm._clear_sacct_cache)
         self.QUEUED = 0
         self.RUNNING = 1
         self.FINISHED = 2
@@ -1289,15 +954,8 @@ class TestJobStatus(unittest.TestCase):
                 },
             },
         }
-        self.expected_keys = [
-            'id', 'name', 'sub_time', 'tasks',
-        ]
-        self.expected_keys.sort()
-
-        self.task_expected_keys = [
-            'status', 'start_time', 'end_time',
-        ]
-        self.task_expected_keys.sort()
+        self.expected_keys = {'id', 'name', 'sub_time', 'tasks', }
+        self.task_expected_keys = {'status', 'start_time', 'end_time', }
 
         self.slurm_example_sacct = (
             '''1716106|acctest|2018-06-05T09:42:24|2018-06-05T09:42:24|'''
@@ -1320,23 +978,24 @@ class TestJobStatus(unittest.TestCase):
             mock_sprun.reset_mock()
             mock_sprun.side_effect = None
             with self.subTest('No job'):
-                mock_sprun.return_value = subprocess.CompletedProcess(
-                    '/usr/bin/sacct',
-                    stdout='',
-                    stderr='',
-                    returncode=0
-                )
+                mock_sprun.return_value = sacct_result()
                 self.assertRaises(
                     UnknownJobId,
                     fsl_sub_plugin_slurm._get_sacct,
                     1716106)
             mock_sprun.reset_mock()
+            with self.subTest('sacct error'):
+                mock_sprun.return_value = sacct_result(
+                    stderr='sacct: error: Problem talking to the database',
+                    returncode=1)
+                self.assertRaises(
+                    GridOutputError,
+                    fsl_sub_plugin_slurm._get_sacct,
+                    1716106)
+            mock_sprun.reset_mock()
             with self.subTest('Single job'):
-                mock_sprun.return_value = subprocess.CompletedProcess(
-                    '/usr/bin/sacct',
-                    stdout=self.slurm_example_sacct,
-                    returncode=0
-                )
+                mock_sprun.return_value = sacct_result(
+                    stdout=self.slurm_example_sacct)
                 self.assertDictEqual(
                     fsl_sub_plugin_slurm._get_sacct(1716106),
                     {
@@ -1357,30 +1016,121 @@ class TestJobStatus(unittest.TestCase):
                 )
         with self.subTest("Completed"):
             with patch('fsl_sub_plugin_slurm.sp.run', autospec=True) as mock_sprun:
-                mock_sprun.return_value = subprocess.CompletedProcess(
-                    ['sacct'], 0, self.sacct_finished_out, '')
+                mock_sprun.return_value = sacct_result(
+                    stdout=self.sacct_finished_out)
                 job_stat = fsl_sub_plugin_slurm.job_status(123456)
-            output_keys = list(job_stat.keys())
-            output_keys.sort()
-            self.assertListEqual(output_keys, self.expected_keys)
-            task_output_keys = list(job_stat['tasks'][1].keys())
-            task_output_keys.sort()
-            self.assertListEqual(task_output_keys, self.task_expected_keys)
+            self.assertSetEqual(set(job_stat), self.expected_keys)
+            self.assertSetEqual(set(job_stat['tasks'][1]), self.task_expected_keys)
             self.assertDictEqual(job_stat, self.sacct_finished_job)
 
+        fsl_sub_plugin_slurm._clear_sacct_cache()
         with self.subTest("Running"):
             with patch('fsl_sub_plugin_slurm.sp.run', autospec=True) as mock_sprun:
-                mock_sprun.return_value = subprocess.CompletedProcess(
-                    ['sacct'], 0, self.sacct_failedbatch_out, '')
+                mock_sprun.return_value = sacct_result(
+                    stdout=self.sacct_failedbatch_out)
                 job_stat = fsl_sub_plugin_slurm.job_status(123456)
-            output_keys = list(job_stat.keys())
-            output_keys.sort()
-            self.assertListEqual(output_keys, self.expected_keys)
-            task_output_keys = list(job_stat['tasks'][1].keys())
-            task_output_keys.sort()
-            self.assertListEqual(task_output_keys, self.task_expected_keys)
+            self.assertSetEqual(set(job_stat), self.expected_keys)
+            self.assertSetEqual(set(job_stat['tasks'][1]), self.task_expected_keys)
             self.assertDictEqual(job_stat, self.sacct_failedbatch_job)
 
+    @patch('fsl_sub_plugin_slurm._sacct_cmd', return_value='/usr/bin/sacct')
+    def test_job_status_array_task(self, mock_qacct):
+        sacct_array_out = (
+            '''123456_1|myarray|2017-10-16T05:28:38|2017-10-16T05:29:24|2017-10-16T06:25:45|COMPLETED|0:0
+123456_1.batch|batch|2017-10-16T05:29:24|2017-10-16T05:29:24|2017-10-16T06:25:45|COMPLETED|0:0
+123456_2|myarray|2017-10-16T05:28:38|2017-10-16T05:29:25|Unknown|RUNNING|0:0
+''')
+        with patch('fsl_sub_plugin_slurm.sp.run', autospec=True) as mock_sprun:
+            mock_sprun.return_value = sacct_result(stdout=sacct_array_out)
+            for name, job_id, sub_job_id in (
+                    ("Separate task ID", 123456, 2),
+                    ("Task ID in job ID", '123456.2', None), ):
+                fsl_sub_plugin_slurm._clear_sacct_cache()
+                mock_sprun.reset_mock()
+                with self.subTest(name):
+                    self.assertDictEqual(
+                        fsl_sub_plugin_slurm.job_status(job_id, sub_job_id),
+                        {
+                            'id': 123456,
+                            'name': 'myarray',
+                            'sub_time': datetime.datetime(2017, 10, 16, 5, 28, 38),
+                            'tasks': {
+                                2: {
+                                    'status': self.RUNNING,
+                                    'start_time': datetime.datetime(2017, 10, 16, 5, 29, 25),
+                                    'end_time': None,
+                                },
+                            },
+                        }
+                    )
+                    mock_sprun.assert_called_once_with(
+                        ['/usr/bin/sacct', '-j', '123456', ] + list(fsl_sub_plugin_slurm._SACCT_ARGS),
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        universal_newlines=True)
+            with self.subTest("Cached whole job"):
+                self.assertListEqual(
+                    list(fsl_sub_plugin_slurm.job_status(123456)['tasks']), [1, 2, ])
+                mock_sprun.assert_called_once()
+
+    @patch('fsl_sub_plugin_slurm._sacct_cmd', return_value='/usr/bin/sacct')
+    def test_job_status_many(self, mock_qacct):
+        with patch('fsl_sub_plugin_slurm.sp.run', autospec=True) as mock_sprun:
+            with self.subTest('No jobs'):
+                self.assertDictEqual(fsl_sub_plugin_slurm.job_status_many([]), {})
+                mock_sprun.assert_not_called()
+            with self.subTest('Two jobs'):
+                mock_sprun.return_value = sacct_result(
+                    stdout=self.sacct_finished_out + '\n' + self.sacct_failedbatch_out.replace('123456', '123457'))
+                self.assertDictEqual(
+                    fsl_sub_plugin_slurm.job_status_many([123456, '123457', 123458]),
+                    {
+                        123456: self.sacct_finished_job,
+                        123457: dict(self.sacct_failedbatch_job, id=123457),
+                    }
+                )
+                mock_sprun.assert_called_once_with(
+                    ['/usr/bin/sacct', '-j', '123456,123457,123458', ]
+                    + list(fsl_sub_plugin_slurm._SACCT_ARGS),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True)
+            mock_sprun.reset_mock()
+            fsl_sub_plugin_slurm._clear_sacct_cache()
+            with self.subTest('sacct error'):
+                mock_sprun.return_value = sacct_result(
+                    stderr='sacct: error: Problem talking to the database',
+                    returncode=1)
+                self.assertRaises(
+                    GridOutputError,
+                    fsl_sub_plugin_slurm.job_status_many,
+                    [123456])
+
+    @patch('fsl_sub_plugin_slurm._sacct_cmd', return_value='/usr/bin/sacct')
+    @patch('fsl_sub_plugin_slurm.time.monotonic', autospec=True, return_value=1000.0)
+    def test_sacct_cache(self, mock_monotonic, mock_qacct):
+        with patch('fsl_sub_plugin_slurm.sp.run', autospec=True) as mock_sprun:
+            mock_sprun.side_effect = lambda *args, **kwargs: sacct_result(
+                stdout=self.sacct_finished_out)
+            with self.subTest('Reused'):
+                job_stat = fsl_sub_plugin_slurm.job_status(123456)
+                job_stat['name'] = 'changed'
+                self.assertDictEqual(
+                    fsl_sub_plugin_slurm.job_status(123456),
+                    self.sacct_finished_job)
+                self.assertEqual(mock_sprun.call_count, 1)
+            with self.subTest('Expired'):
+                mock_monotonic.return_value += fsl_sub_plugin_slurm._SACCT_CACHE_TTL
+                fsl_sub_plugin_slurm.job_status(123456)
+                self.assertEqual(mock_sprun.call_count, 2)
+            mock_sprun.reset_mock()
+            fsl_sub_plugin_slurm._clear_sacct_cache()
+            with self.subTest('Unknown jobs not cached'):
+                mock_sprun.side_effect = lambda *args, **kwargs: sacct_result()
+                for _ in range(2):
+                    self.assertIsNone(fsl_sub_plugin_slurm.job_status(123456))
+                self.assertEqual(mock_sprun.call_count, 2)
+
 
 class TestQueueCapture(unittest.TestCase):
     def setUp(self):
@@ -1399,11 +1149,11 @@ class TestQueueCapture(unittest.TestCase):
         self.sinfo_G_no_type = 'gpu:2(S:0-1)'
         self.sinfo_G_multiplier = 'gpu:2K(S:0-2023)'
         self.sinfo_G_list = 'gpu:p100:2(S:0-1),gpu:v100:2(S:0-1)'
-        self.sinfo_O_one_host = '''8                  UNLIMITED           64000             1-00:00:00          htc-node1
+        self.sinfo_O_one_host = b'''8                  UNLIMITED           64000             1-00:00:00          htc-node1
 '''
-        self.sinfo_O_one_host_inf = '''8                  UNLIMITED           64000             infinite          htc-node1
+        self.sinfo_O_one_host_inf = b'''8                  UNLIMITED           64000             infinite          htc-node1
 '''
-        self.sinfo_O_two_host = '''8                   UNLIMITED           384000               1-00:00:00          htc-gpu1
+        self.sinfo_O_two_host = b'''8                   UNLIMITED           384000               1-00:00:00          htc-gpu1
 16                 UNLIMITED           512000               5-00:00:00          htc-gpu2
 '''
 
@@ -1594,6 +1344,133 @@ class TestQueueCapture(unittest.TestCase):
             self.maxDiff = None
             self.assertEqual(qd_str.getvalue(), eq_str.getvalue())
 
+    @patch('fsl_sub_plugin_slurm._sinfo_cmd', return_value='/usr/bin/sinfo')
+    @patch('fsl_sub_plugin_slurm.method_config', return_value=conf_dict['method_opts']['slurm'])
+    def test_build_queue_defs_many_partitions(self, mock_mconf, mock_sinfo):
+        partitions = ('short', 'long', 'htc', )
+        cpus = {'short': 4, 'long': 8, 'htc': 16, }
+        last_queried = threading.Event()
+
+        def fake_sinfo(cmd, **kwargs):
+            if '-s' in cmd:
+                return subprocess.CompletedProcess(cmd, 0, 'short*\nlong\nhtc\n')
+            queue = cmd[cmd.index('-p') + 1]
+            if queue == partitions[-1]:
+                last_queried.set()
+            elif queue == partitions[0]:
+                # Make the first partition's answers arrive after the last's
+                last_queried.wait(timeout=5)
+            if '-O' in cmd:
+                return subprocess.CompletedProcess(
+                    cmd, 0,
+                    '{0} UNLIMITED 64000 1-00:00:00 {1}-node1\n'.format(cpus[queue], queue).encode())
+            if '%G' in cmd:
+                return subprocess.CompletedProcess(cmd, 0, '(null)')
+            return subprocess.CompletedProcess(cmd, 0, 'os:centos7,\n')
+
+        with patch('fsl_sub_plugin_slurm.sp.run', side_effect=fake_sinfo):
+            with self.subTest("Partitions"):
+                queue_list, queue_data = fsl_sub_plugin_slurm._get_partitions()
+                self.assertTrue(last_queried.is_set())
+                self.assertListEqual(queue_list, list(partitions))
+                self.assertListEqual(
+                    [(qinfo['qname'], qinfo['cpus']) for qinfo, _, _, _ in queue_data],
+                    [(q, cpus[q]) for q in partitions])
+            last_queried.clear()
+            with self.subTest("Queue definitions"):
+                qdefs = fsl_sub_plugin_slurm.build_queue_defs()
+                self.assertListEqual(list(qdefs['queues']), list(partitions))
+                self.assertListEqual(
+                    [qdefs['queues'][q]['max_slots'] for q in partitions],
+                    [cpus[q] for q in partitions])
+
+    @patch('fsl_sub_plugin_slurm._sinfo_cmd', return_value='/usr/bin/sinfo')
+    @patch('fsl_sub_plugin_slurm.method_config', return_value=conf_dict['method_opts']['slurm'])
+    @patch('fsl_sub_plugin_slurm._slurm_conf_mtime', return_value=1234.5)
+    def test_build_queue_defs_cache(self, mock_mtime, mock_mconf, mock_sinfo):
+        sinfo_outputs = (
+            subprocess.CompletedProcess(
+                ['sinfo', '-s', ], 0, self.sinfo_s
+            ),
+            subprocess.CompletedProcess(
+                ['sinfo', '%O', ], 0, self.sinfo_O_one_host
+            ),
+            subprocess.CompletedProcess(
+                ['sinfo', '%G', ], 0, self.sinfo_G_one_host
+            ),
+            subprocess.CompletedProcess(
+                ['sinfo', '%f', ], 0, self.sinfo_f_one_host
+            )
+        )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, 'fsl_sub', 'slurm_partitions.pkl')
+            with patch('fsl_sub_plugin_slurm._PARTITION_CACHE_FILE', cache_file), \
+                    patch.dict('fsl_sub_plugin_slurm.os.environ', {'FSLSUB_SLURM_CACHE': '1'}):
+                with self.subTest("Populate cache"):
+                    with patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs):
+                        qdefs = fsl_sub_plugin_slurm.build_queue_defs()
+                    self.assertTrue(os.path.exists(cache_file))
+                with self.subTest("Use cache"):
+                    with patch('fsl_sub_plugin_slurm.sp.run') as mock_spr:
+                        self.assertEqual(
+                            fsl_sub_plugin_slurm.build_queue_defs(),
+                            qdefs)
+                        mock_spr.assert_not_called()
+                with self.subTest("Configuration changed"):
+                    mock_mtime.return_value = 5678.9
+                    with patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs) as mock_spr:
+                        fsl_sub_plugin_slurm.build_queue_defs()
+                        self.assertEqual(mock_spr.call_count, 4)
+                with self.subTest("Memory units changed"):
+                    mock_mconf.return_value = dict(
+                        conf_dict['method_opts']['slurm'],
+                        memory_in_gb=not conf_dict['method_opts']['slurm']['memory_in_gb'])
+                    with patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs) as mock_spr:
+                        fsl_sub_plugin_slurm.build_queue_defs()
+                        self.assertEqual(mock_spr.call_count, 4)
+                with self.subTest("Plugin upgraded"):
+                    with patch('fsl_sub_plugin_slurm.PLUGIN_VERSION', '999.0.0'), \
+                            patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs) as mock_spr:
+                        fsl_sub_plugin_slurm.build_queue_defs()
+                        self.assertEqual(mock_spr.call_count, 4)
+                with self.subTest("Configless Slurm"):
+                    mock_mtime.return_value = None
+                    os.remove(cache_file)
+                    with patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs) as mock_spr, \
+                            self.assertLogs('fsl_sub.fsl_sub_plugin_slurm', level='WARNING') as logs:
+                        fsl_sub_plugin_slurm.build_queue_defs()
+                        self.assertEqual(mock_spr.call_count, 4)
+                    self.assertIn('will not be cached', logs.output[0])
+                    self.assertFalse(os.path.exists(cache_file))
+                mock_mtime.return_value = 1234.5
+                for name, content in (
+                        ("Truncated cache", b'\x80\x04'),
+                        ("Corrupt cache", b'not a pickle'),
+                        ("Foreign cache", b'cfsl_sub_plugin_slurm\nno_such_attribute\n.'), ):
+                    with self.subTest(name):
+                        with open(cache_file, 'wb') as cache_f:
+                            cache_f.write(content)
+                        with patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs) as mock_spr:
+                            fsl_sub_plugin_slurm.build_queue_defs()
+                            self.assertEqual(mock_spr.call_count, 4)
+                        with patch('fsl_sub_plugin_slurm.sp.run') as mock_spr:
+                            fsl_sub_plugin_slurm.build_queue_defs()
+                            mock_spr.assert_not_called()
+                for name, failure in (
+                        ("Failed replace", patch('fsl_sub_plugin_slurm.os.replace', side_effect=OSError('Disk full'))),
+                        ("Failed pickle", patch(
+                            'fsl_sub_plugin_slurm.pickle.dump', side_effect=pickle.PicklingError('Bad object'))), ):
+                    with self.subTest(name):
+                        os.remove(cache_file)
+                        with patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs), failure, \
+                                self.assertLogs('fsl_sub.fsl_sub_plugin_slurm', level='WARNING') as logs:
+                            fsl_sub_plugin_slurm.build_queue_defs()
+                        self.assertIn('Unable to write partition cache', logs.output[0])
+                        self.assertListEqual(os.listdir(os.path.dirname(cache_file)), [])
+                        # Leave a valid cache for the next subtest to remove
+                        with patch('fsl_sub_plugin_slurm.sp.run', side_effect=sinfo_outputs):
+                            fsl_sub_plugin_slurm.build_queue_defs()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
-from setuptools import setup, find_packages
+import ast
+from setuptools import setup
 
 with open('fsl_sub_plugin_slurm/version.py', mode='r') as vf:
-    vl = vf.read().strip()
+    version_tree = ast.parse(vf.read())
 
-PLUGIN_VERSION = vl.split(' = ')[1].strip("'")
+# Read PLUGIN_VERSION without importing the package (and its dependencies)
+PLUGIN_VERSION = next(
+    ast.literal_eval(node.value) for node in version_tree.body
+    if isinstance(node, ast.Assign) and any(
+        getattr(t, 'id', None) == 'PLUGIN_VERSION' for t in node.targets))
 
 setup(
     name='fsl_sub_plugin_slurm',
@@ -33,7 +38,7 @@ setup(
         'Documentation': 'https://fsl.fmrib.ox.ac.uk/fsl/fslwiki',
         'Source': 'https://git.fmrib.ox.ac.uk/fsl/fsl_sub_plugin_slurm'
     },
-    packages=find_packages(),
+    packages=['fsl_sub_plugin_slurm', 'fsl_sub_plugin_slurm.tests', ],
     license='FSL License',
     install_requires=['fsl_sub>=2.5.6', 'ruamel.yaml>=0.16.7', ],
     setup_requires=['ruamel.yaml', ],